@@ -116,10 +116,10 @@ if __name__ == "__main__":
             n_cls_preds = len(unique_labels)
             bbox_colors = colors
 
-            for cls_pred, x1, y1, x2, y2, angle in detections:
+            # New co-ordinates of all rotated bboxes
+            corners = rotate_detections(detections[:, 1], detections[:, 2], detections[:, 3], detections[:, 4], detections[:, 5])
+            for (cls_pred, x1, y1, x2, y2, angle), xy in zip(detections, corners):
 
-                # New co-ordinates of the rotated bbox
-                xy = rotate_detections(x1, y1, x2, y2, angle)
                 #Make the co-ordinates compatible for cv2
                 pts = np.array(xy, np.int32).reshape((-1,1,2))
                 
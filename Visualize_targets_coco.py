@@ -35,13 +35,8 @@ def draw_xywha(im, x, y, w, h, angle=0, color=(255,0,0), linewidth=5):
     im: image numpy array, shape(h,w,3), RGB
     angle: degree
     '''
-    c, s = np.cos(angle/180*np.pi), np.sin(angle/180*np.pi)
-    R = np.asarray([[c, s], [-s, c]])
-    pts = np.asarray([[-w/2, -h/2], [w/2, -h/2], [w/2, h/2], [-w/2, h/2]])
-    rot_pts = []
-    for pt in pts:
-        rot_pts.append(([x, y] + pt @ R).astype(int))
-    contours = np.array([rot_pts[0], rot_pts[1], rot_pts[2], rot_pts[3]])
+    box = torch.tensor([[float(x), float(y), float(w), float(h), float(angle)]])
+    contours = xywha2corners(box)[0].numpy().astype(int)
     cv2.polylines(im, [contours], isClosed=True, color=color,
                 thickness=linewidth, lineType=cv2.LINE_4)
     return im
@@ -0,0 +1,88 @@
+from __future__ import division
+
+from utils.datasets import *
+
+import time
+import argparse
+
+import torch
+
+
+def time_loading(dataset, num_images):
+    """ Mean seconds per image of __getitem__ plus the resize of collate_fn, and the samples """
+    samples = []
+    start = time.time()
+    for i in range(num_images):
+        path, img, targets = dataset[i]
+        samples.append((path, dataset.collate_fn([(path, img, targets)])[1][0], targets))
+    return (time.time() - start) / num_images, samples
+
+
+def time_batches(dataset, batch_size, num_batches):
+    """
+    Mean seconds per image of the worker side (__getitem__ and collate_fn), mean bytes of the image
+    batches the workers hand to the main process, and the batches
+    """
+    batches = []
+    start = time.time()
+    for b in range(num_batches):
+        batches.append(dataset.collate_fn([dataset[b * batch_size + i] for i in range(batch_size)]))
+    worker_time = (time.time() - start) / (num_batches * batch_size)
+    batch_bytes = np.mean([imgs.numel() * imgs.element_size() for _, imgs, _ in batches])
+    return worker_time, batch_bytes, batches
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare pad-then-resize loading with the reduced-scale letterbox (fast_letterbox) per dataset")
+    parser.add_argument("--list_paths", type=str, nargs="+", required=True, help="list files of the datasets to measure")
+    parser.add_argument("--num_images", type=int, default=200, help="images measured per dataset")
+    parser.add_argument("--img_size", type=int, default=416, help="size of each image dimension")
+    parser.add_argument("--use_angle", default='False', help="label variant of the lists")
+    parser.add_argument("--class_num", type=int, default=1, help="number of classes of the lists")
+    parser.add_argument("--uint8_batch_size", type=int, default=0, help="also compare float and uint8 worker output (uint8_output) with batches of this size")
+    parser.add_argument("--train_data", type=str, default="imagenet", help="normalization values of the uint8 comparison")
+    opt = parser.parse_args()
+    print(opt)
+
+    torch.set_num_threads(1)
+    for list_path in opt.list_paths:
+        datasets = [
+            ListDataset(list_path, opt.use_angle, opt.class_num, img_size=opt.img_size, augment=False, multiscale=False,
+                        normalized_labels=False, fast_letterbox=fast_letterbox)
+            for fast_letterbox in (False, True)
+        ]
+        num_images = min(opt.num_images, len(datasets[0]))
+        # Warm up the page cache so both modes read the files from memory
+        time_loading(datasets[0], num_images)
+        pad_time, pad_samples = time_loading(datasets[0], num_images)
+        letterbox_time, letterbox_samples = time_loading(datasets[1], num_images)
+
+        # Differences of the outputs: pixels (resampling) and relative targets
+        pixel_diff = np.mean([(a[1] - b[1]).abs().mean().item() for a, b in zip(pad_samples, letterbox_samples)])
+        target_diff = max([(a[2][:, 2:] - b[2][:, 2:]).abs().max().item() for a, b in zip(pad_samples, letterbox_samples)
+                           if a[2] is not None and len(a[2])] or [0])
+        print(f"{list_path}: pad then resize {1000 * pad_time:.2f} ms/image, letterbox {1000 * letterbox_time:.2f} ms/image, "
+              f"speedup {pad_time / letterbox_time:.2f}x, mean pixel difference {pixel_diff:.4f}, max target difference {target_diff:.5f}")
+
+        if opt.uint8_batch_size:
+            datasets = [
+                ListDataset(list_path, opt.use_angle, opt.class_num, img_size=opt.img_size, augment=False, multiscale=False,
+                            normalized_labels=False, pixel_norm=True, train_data=opt.train_data, uint8_output=uint8_output)
+                for uint8_output in (False, True)
+            ]
+            num_batches = max(1, num_images // opt.uint8_batch_size)
+            float_time, float_bytes, float_batches = time_batches(datasets[0], opt.uint8_batch_size, num_batches)
+            uint8_time, uint8_bytes, uint8_batches = time_batches(datasets[1], opt.uint8_batch_size, num_batches)
+
+            # Consumer side: the fused conversion and normalization of BatchPrefetcher on this process' device
+            prefetcher = BatchPrefetcher(uint8_batches, "cuda" if torch.cuda.is_available() else "cpu",
+                                         mean=datasets[1].mean_t, std=datasets[1].std_t)
+            start = time.time()
+            normalized = [imgs for _, imgs, _ in prefetcher]
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            normalize_time = (time.time() - start) / (num_batches * opt.uint8_batch_size)
+            pixel_diff = max((a[1].to(b.device) - b).abs().max().item() for a, b in zip(float_batches, normalized))
+            print(f"{list_path}: float output {1000 * float_time:.2f} ms/image in workers, {float_bytes / 2**20:.1f} MiB/batch; "
+                  f"uint8 output {1000 * uint8_time:.2f} ms/image in workers, {uint8_bytes / 2**20:.1f} MiB/batch, "
+                  f"{1000 * normalize_time:.3f} ms/image fused normalization; max pixel difference {pixel_diff:.2e}")
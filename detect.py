@@ -26,14 +26,20 @@ from matplotlib.ticker import NullLocator
 
 import cv2
 
-def draw_bbox(model, image_folder, img_size, class_path, conf_thres, nms_thres, out_dir, train_data, use_angle, batch_size=1, n_cpu=0,):
+def draw_bbox(model, image_folder, img_size, class_path, conf_thres, nms_thres, out_dir, train_data, use_angle, batch_size=1, n_cpu=0, nms_mode="greedy",
+              pre_nms_topk=None, pre_nms_topk_per_class=None, max_det=None, fast_letterbox=False, normalize=True, rect=False):
     model.eval()  # Set in evaluation mode
 
+    dataset = ImageFolder(image_folder, img_size=img_size, train_data=train_data, fast_letterbox=fast_letterbox, normalize=normalize)
+    if rect:
+        # Batches of images with similar aspect ratios, letterboxed to the smallest rectangle of the batch
+        loader_kwargs = dict(batch_sampler=AspectRatioBatchSampler(dataset.files, batch_size, img_size))
+    else:
+        loader_kwargs = dict(batch_size=batch_size, shuffle=False)
     dataloader = DataLoader(
-        ImageFolder(image_folder, img_size=img_size, train_data=train_data),
-        batch_size=batch_size,
-        shuffle=False,
+        dataset,
         num_workers=n_cpu,
+        **loader_kwargs,
     )
 
     classes = load_classes(class_path)  # Extracts class labels from file
@@ -41,7 +47,9 @@ def draw_bbox(model, image_folder, img_size, class_path, conf_thres, nms_thres,
     Tensor = torch.cuda.FloatTensor if torch.cuda.is_available() else torch.FloatTensor
 
     imgs = []  # Stores image paths
-    img_detections = []  # Stores detections for each image index
+    input_shapes = []  # (h, w) of the network input of each image
+    img_detections = []  # Stores packed detections for each batch
+    img_offsets = [0]  # Detections of image i are rows img_offsets[i]:img_offsets[i + 1]
 
     print("\nPerforming object detection:")
     prev_time = time.time()
@@ -53,7 +61,8 @@ def draw_bbox(model, image_folder, img_size, class_path, conf_thres, nms_thres,
         # Get detections
         with torch.no_grad():
             detections = model(input_imgs, use_angle=use_angle)
-            detections = non_max_suppression(detections, conf_thres, nms_thres)
+            detections, offsets = non_max_suppression(detections, use_angle, conf_thres, nms_thres, nms_mode=nms_mode, pre_nms_topk=pre_nms_topk,
+                                                      pre_nms_topk_per_class=pre_nms_topk_per_class, max_det=max_det)
 
         # Log progress
         current_time = time.time()
@@ -63,16 +72,21 @@ def draw_bbox(model, image_folder, img_size, class_path, conf_thres, nms_thres,
 
         # Save image and detections
         imgs.extend(img_paths)
-        img_detections.extend(detections)
+        input_shapes.extend([tuple(input_imgs.shape[-2:])] * len(img_paths))
+        img_detections.append(detections)
+        img_offsets.extend((offsets[1:] + img_offsets[-1]).tolist())
 
         # if batch_i == 4:
         #     break
 
     colors = [(0,134,213), (220,0,213), (255,0,0), (255, 233, 0), (0,255,0), (0,0,255)]
 
+    img_detections = torch.cat(img_detections)
+
     print("\nSaving images:")
     # Iterate through images and save plot of detections
-    for img_i, (path, detections) in enumerate(zip(imgs, img_detections)):
+    for img_i, path in enumerate(imgs):
+        detections = img_detections[img_offsets[img_i]:img_offsets[img_i + 1], 1:]
 
         print("(%d) Image: '%s'" % (img_i, path))
 
@@ -84,18 +98,18 @@ def draw_bbox(model, image_folder, img_size, class_path, conf_thres, nms_thres,
         #ax.imshow(img)
 
         # Draw bounding boxes and labels of detections
-        if detections is not None:
+        if len(detections):
             # Rescale boxes to original image
-            detections = rescale_boxes(detections, img_size, img.shape[:2])
+            detections = rescale_boxes(detections, input_shapes[img_i], img.shape[:2])
             unique_labels = detections[:, -1].cpu().unique()
             n_cls_preds = len(unique_labels)
             bbox_colors = colors
-            for x1, y1, x2, y2, angle, conf, cls_conf, cls_pred in detections:
+            # New co-ordinates of all rotated bboxes
+            corners = rotate_detections(detections[:, 0], detections[:, 1], detections[:, 2], detections[:, 3], detections[:, 4])
+            for (x1, y1, x2, y2, angle, conf, cls_conf, cls_pred), xy in zip(detections, corners):
 
                 print("\t+ Label: %s, Conf: %.5f" % (classes[int(cls_pred)], cls_conf.item()))
 
-                # New co-ordinates of the rotated bbox
-                xy = rotate_detections(x1, y1, x2, y2, angle)
                 pts = np.array(xy, np.int32).reshape((-1,1,2))
 
                 #box_w = x2 - x1
@@ -124,7 +138,7 @@ def draw_bbox(model, image_folder, img_size, class_path, conf_thres, nms_thres,
                 #     bbox={"color": color_mat, "pad": 0},
                 # )
 
-        if detections is not None:
+        if len(detections):
             # Save generated image with detections
             plt.axis("off")
             plt.gca().xaxis.set_major_locator(NullLocator())
@@ -145,6 +159,13 @@ if __name__ == "__main__":
     parser.add_argument("--class_path", type=str, default="data/class.names", help="path to class label file")
     parser.add_argument("--conf_thres", type=float, default=0.5, help="object confidence threshold")
     parser.add_argument("--nms_thres", type=float, default=0.5, help="iou thresshold for non-maximum suppression")
+    parser.add_argument("--nms_mode", type=str, default="greedy", choices=["greedy", "fast", "cluster"], help="greedy NMS or matrix based Fast/Cluster NMS")
+    parser.add_argument("--pre_nms_topk", type=int, default=None, help="max number of candidates per image before NMS")
+    parser.add_argument("--pre_nms_topk_per_class", type=int, default=None, help="max number of candidates per class before NMS")
+    parser.add_argument("--max_det", type=int, default=None, help="max number of detections per image after NMS")
+    parser.add_argument("--fast_letterbox", action="store_true", help="decode JPEGs at reduced scale and resize before padding")
+    parser.add_argument("--fold_norm", action="store_true", help="fold the mean/std normalization into the first convolution, images are not normalized")
+    parser.add_argument("--rect", action="store_true", help="batch images of similar aspect ratio into rectangular inputs instead of squares")
     parser.add_argument("--batch_size", type=int, default=1, help="size of the batches")
     parser.add_argument("--n_cpu", type=int, default=0, help="number of cpu threads to use during batch generation")
     parser.add_argument("--img_size", type=int, default=416, help="size of each image dimension")
@@ -179,6 +200,11 @@ if __name__ == "__main__":
             model.load_darknet_weights(opt.pretrained_weights)
     #model = model.model 
     train_data = opt.dataset
+    if opt.fold_norm:
+        # The model takes [0, 1] images, the images are only decoded and letterboxed
+        norm_folder = ImageFolder(opt.image_folder, train_data=train_data)
+        if norm_folder.pixel_norm:
+            model.fold_input_normalization(norm_folder.mean_t, norm_folder.std_t)
 
     draw_bbox(model=model,
             image_folder=opt.image_folder,
@@ -190,6 +216,13 @@ if __name__ == "__main__":
             batch_size=opt.batch_size,
             n_cpu=opt.n_cpu,
             train_data=train_data,
-            use_angle=opt.use_angle)
+            use_angle=opt.use_angle,
+            nms_mode=opt.nms_mode,
+            pre_nms_topk=opt.pre_nms_topk,
+            pre_nms_topk_per_class=opt.pre_nms_topk_per_class,
+            max_det=opt.max_det,
+            fast_letterbox=opt.fast_letterbox,
+            normalize=not opt.fold_norm,
+            rect=opt.rect)
 
     
\ No newline at end of file
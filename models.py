@@ -119,6 +119,7 @@ class YOLOLayer(nn.Module):
         self.metrics = {}
         self.img_dim = img_dim
         self.grid_size = 0  # grid size
+        self.grid_w = 0  # grid columns, differ from grid_size for rectangular inputs
         self.angle_range = 360   # 180 or 360
         self.rot_l1 = nn.L1Loss(reduction='sum')
         self.entropy_lambda = 0.0001  ## 0.001
@@ -158,14 +159,16 @@ class YOLOLayer(nn.Module):
 
         return loss
 
-    def compute_grid_offsets(self, grid_size, cuda=True):
+    def compute_grid_offsets(self, grid_size, cuda=True, grid_w=None):
+        """ grid_size: rows of the grid, grid_w: columns of a rectangular grid (default square) """
         self.grid_size = grid_size
-        g = self.grid_size
+        self.grid_w = grid_w if grid_w is not None else grid_size
+        g, gw = self.grid_size, self.grid_w
         FloatTensor = torch.cuda.FloatTensor if cuda else torch.FloatTensor
         self.stride = self.img_dim / self.grid_size
         # Calculate offsets for each grid
-        self.grid_x = torch.arange(g).repeat(g, 1).view([1, 1, g, g]).type(FloatTensor)
-        self.grid_y = torch.arange(g).repeat(g, 1).t().view([1, 1, g, g]).type(FloatTensor)
+        self.grid_x = torch.arange(gw).repeat(g, 1).view([1, 1, g, gw]).type(FloatTensor)
+        self.grid_y = torch.arange(g).repeat(gw, 1).t().view([1, 1, g, gw]).type(FloatTensor)
         self.scaled_anchors = FloatTensor([(a_w / self.stride, a_h / self.stride) for a_w, a_h in self.anchors])
         self.anchor_w = self.scaled_anchors[:, 0:1].view((1, self.num_anchors, 1, 1))
         self.anchor_h = self.scaled_anchors[:, 1:2].view((1, self.num_anchors, 1, 1))
@@ -180,9 +183,10 @@ class YOLOLayer(nn.Module):
         self.img_dim = img_dim
         num_samples = x.size(0)
         grid_size = x.size(2)
+        grid_w = x.size(3)
 
         prediction = (
-            x.view(num_samples, self.num_anchors, self.num_classes + 6, grid_size, grid_size)
+            x.view(num_samples, self.num_anchors, self.num_classes + 6, grid_size, grid_w)
             .permute(0, 1, 3, 4, 2)
             .contiguous()
         )
@@ -204,8 +208,8 @@ class YOLOLayer(nn.Module):
         pred_cls = torch.sigmoid(prediction[..., 6:])  # Cls pred.   ### Changes for single class
         
         # If grid size does not match current we compute new offsets
-        if grid_size != self.grid_size:
-            self.compute_grid_offsets(grid_size, cuda=x.is_cuda)
+        if grid_size != self.grid_size or grid_w != self.grid_w:
+            self.compute_grid_offsets(grid_size, cuda=x.is_cuda, grid_w=grid_w)
 
         # Add offset and scale with anchors
         pred_boxes = FloatTensor(prediction[..., :5].shape)
@@ -354,6 +358,8 @@ class Darknet(nn.Module):
         self.img_size = img_size
         self.seen = 0
         self.header_info = np.array([0, 0, 0, self.seen, 0], dtype=np.int32)
+        # (mean, std, scale) once folded into the first convolution (see fold_input_normalization)
+        self.input_normalization = None
 
     def forward(self, x, use_angle=False, targets=None, uda_method=None):
         img_dim = x.shape[2]
@@ -378,6 +384,31 @@ class Darknet(nn.Module):
         elif uda_method == 'minent':
             return (loss, yolo_outputs)
 
+    def fold_input_normalization(self, mean, std, scale=1.0):
+        """
+        Folds the per channel input normalization (x / scale - mean) / std into the first convolution, the
+        model then takes the raw input: [0, 1] images (scale=1) or uint8 values as float (scale=255).
+        The conv weights are divided by scale * std and the constant -sum(w * mean / std) moves into the
+        conv bias, or into the running mean of its batch norm (conv without bias).
+        Exact except at the border of the first feature map: the zero padding of the conv was a normalized
+        zero (the mean color) and now is a raw zero, the outputs there differ.
+        """
+        if self.input_normalization is not None:
+            raise RuntimeError("Input normalization is already folded into the first convolution")
+        module_def, module = next((module_def, module) for module_def, module in zip(self.module_defs, self.module_list)
+                                  if module_def["type"] == "convolutional")
+        conv_layer = module[0]
+        weight = conv_layer.weight.data
+        mean = torch.tensor(mean, dtype=weight.dtype, device=weight.device).view(1, -1, 1, 1)
+        std = torch.tensor(std, dtype=weight.dtype, device=weight.device).view(1, -1, 1, 1)
+        shift = -(weight * mean / std).sum(dim=(1, 2, 3))
+        conv_layer.weight.data = weight / (scale * std)
+        if int(module_def["batch_normalize"]):
+            module[1].running_mean.data -= shift
+        else:
+            conv_layer.bias.data += shift
+        self.input_normalization = (mean.flatten().tolist(), std.flatten().tolist(), scale)
+
     def load_darknet_weights(self, weights_path):
         """Parses and loads the weights stored in 'weights_path'"""
 
@@ -0,0 +1,17 @@
+from __future__ import division
+
+from utils.image_store import pack_image_store
+
+import argparse
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pack the images of a list file into a memory-mapped store for ListDataset(image_store=...)")
+    parser.add_argument("--list_path", type=str, required=True, help="list file of the images (train or valid of the data config)")
+    parser.add_argument("--store_path", type=str, required=True, help="output directory of the store")
+    parser.add_argument("--img_size", type=int, nargs="+", default=[416], help="letterbox sizes to pack")
+    parser.add_argument("--n_cpu", type=int, default=8, help="number of processes decoding images")
+    opt = parser.parse_args()
+    print(opt)
+
+    pack_image_store(opt.list_path, opt.store_path, sizes=opt.img_size, n_cpu=opt.n_cpu)
@@ -4,8 +4,13 @@ from models import *
 from utils.utils import *
 from utils.datasets import *
 from utils.parse_config import *
+from utils.prediction_cache import PredictionCache, prediction_cache_key
 
 import os
+import inspect
+import queue
+import collections
+from concurrent.futures import Future, ThreadPoolExecutor
 os.environ['CUDA_VISIBLE_DEVICES'] = '0,1,2,3,4,5,6 '  # 0,1,2,3,4,5,6
 import sys
 import time
@@ -21,81 +26,424 @@ from torch.autograd import Variable
 import torch.optim as optim
 
 
-def evaluate(model, path, json_path, iou_thres, conf_thres, nms_thres, img_size, batch_size, class_80, gpu_num, use_angle, class_num, train_data= None):
-    model.eval()
+def batch_statistics(outputs, targets, iou_thres, conf_thres, nms_thres, use_angle, nms_timings=None, **nms_kwargs):
+    """
+    NMS and matching of one batch of raw outputs
+    nms_kwargs: further arguments of non_max_suppression (nms_mode, pre_nms_topk, ...)
+    Returns the (true_positives, pred_scores, pred_labels) of get_batch_statistics as numpy arrays
+    """
+    outputs, _ = non_max_suppression(outputs, conf_thres=conf_thres, nms_thres=nms_thres, use_angle=use_angle, timings=nms_timings, **nms_kwargs)
+    return [
+        (true_positives, to_cpu(pred_scores).numpy(), to_cpu(pred_labels).numpy())
+        for true_positives, pred_scores, pred_labels in get_batch_statistics(outputs, targets, iou_threshold=iou_thres, use_angle=use_angle)
+    ]
 
-    # # Get dataloader
-    # dataset = ImageAnnotation(folder_path=path, json_path=json_path, img_size=img_size, augment=False, multiscale=False, class_80=class_80)
-    # dataloader = torch.utils.data.DataLoader(
-    #     dataset, batch_size=batch_size, shuffle=False, num_workers=4, collate_fn=dataset.collate_fn
-    # )
 
-    dataset = ListDataset(path, augment=False, multiscale=False, normalized_labels=False, pixel_norm=True, train_data=train_data, use_angle=use_angle, class_num=class_num)
-    dataloader = torch.utils.data.DataLoader(
-        dataset,
-        batch_size=batch_size,
-        shuffle=True,
-        num_workers=4,
-        pin_memory=True,
-        collate_fn=dataset.collate_fn,
-    )
+def _accumulate(ap_accumulator, statistics, labels):
+    """ Adds the batch_statistics (or a future of them) and the target labels of a batch to the accumulator """
+    if isinstance(statistics, Future):
+        statistics = statistics.result()
+    for true_positives, pred_scores, pred_labels in statistics:
+        ap_accumulator.update(true_positives, pred_scores, pred_labels, labels)
+
+
+class Evaluator(object):
+    """
+    Validation list with its dataset and dataloader, kept between evaluations (e.g. the epochs of
+    train.py) so the list file, mean/std and the loader workers are only set up once.
+    Workers are persistent where the installed torch supports it (>= 1.7).
+    """
+
+    def __init__(self, path, img_size, batch_size, use_angle, class_num, train_data=None, num_workers=4, shard=None, indices=None,
+                 image_store=None, fast_letterbox=False, uint8_output=False, normalize=True, rect=False):
+        self.img_size = img_size
+        self.batch_size = batch_size
+        self.use_angle = use_angle
+        self.class_num = class_num
+        self.train_data = train_data
+
+        # # Get dataloader
+        # dataset = ImageAnnotation(folder_path=path, json_path=json_path, img_size=img_size, augment=False, multiscale=False, class_80=class_80)
+        # dataloader = torch.utils.data.DataLoader(
+        #     dataset, batch_size=batch_size, shuffle=False, num_workers=4, collate_fn=dataset.collate_fn
+        # )
+
+        self.dataset = ListDataset(path, augment=False, multiscale=False, normalized_labels=False, pixel_norm=True, train_data=train_data,
+                                   use_angle=use_angle, class_num=class_num, shard=shard, indices=indices, image_store=image_store,
+                                   fast_letterbox=fast_letterbox, uint8_output=uint8_output, normalize=normalize)
+        self.rect = rect
+        if rect:
+            # Batches of images with similar aspect ratios, letterboxed to the smallest rectangle of the batch
+            loader_kwargs = dict(batch_sampler=AspectRatioBatchSampler(self.dataset.img_files, batch_size, img_size))
+        else:
+            loader_kwargs = dict(batch_size=batch_size, shuffle=False)
+        if num_workers > 0 and "persistent_workers" in inspect.signature(DataLoader.__init__).parameters:
+            loader_kwargs["persistent_workers"] = True
+        self.dataloader = torch.utils.data.DataLoader(
+            self.dataset,
+            num_workers=num_workers,
+            pin_memory=True,
+            collate_fn=self.dataset.collate_fn,
+            **loader_kwargs,
+        )
+
+    def statistics(self, model, iou_thres, conf_thres, nms_thres, compute_loss=True, nms_mode="greedy", pre_nms_topk=None,
+                   pre_nms_topk_per_class=None, max_det=None, nms_timings=None, score_bins=1000, device=None,
+                   cache_dir=None, cache_conf_floor=0.01, postprocess_workers=0):
+        """
+        Runs inference, NMS and matching over the validation list
+        compute_loss: also run the loss path (build_targets) for the validation loss and accuracy
+        postprocess_workers: run NMS and matching of a batch on this many threads while the next
+        batches are forwarded, at most 2 batches per thread are in flight. The results are added
+        to the accumulator in batch order, so they equal the sequential run (0).
+        With 'cache_dir' the raw head outputs are cached (see PredictionCache), a later call with the same
+        weights, cfg, img_size and dataset only re-runs NMS and matching on the cached predictions
+        Returns the APAccumulator and the sums of the per batch accuracy and loss (None without
+        compute_loss) with the number of batches
+        """
+        model.eval()
+        use_angle, img_size = self.use_angle, self.img_size
+
+        if device is None:
+            device = next(model.parameters()).device
+
+        cache = None
+        if cache_dir is not None:
+            if conf_thres < cache_conf_floor:
+                print(f"conf_thres {conf_thres} is below the cache floor {cache_conf_floor}, predictions are not cached")
+            else:
+                key = prediction_cache_key(model, self.dataset.img_files, self.dataset.label_files, img_size, use_angle, self.class_num,
+                                           self.train_data, cache_conf_floor, fast_letterbox=self.dataset.fast_letterbox, rect=self.rect)
+                cache = PredictionCache(cache_dir, key, conf_floor=cache_conf_floor)
+                if cache.exists():
+                    return statistics_from_cache(cache, iou_thres, conf_thres, nms_thres, self.batch_size, use_angle, self.class_num,
+                                                 nms_mode=nms_mode, pre_nms_topk=pre_nms_topk, pre_nms_topk_per_class=pre_nms_topk_per_class,
+                                                 max_det=max_det, nms_timings=nms_timings, score_bins=score_bins)
+                cache.open()
+
+        # Per class and score bin counts of TP/FP (see APAccumulator), iou_thres can be a sequence of thresholds
+        ap_accumulator = APAccumulator(self.class_num, num_bins=score_bins, num_thresholds=np.size(iou_thres))
+        postprocess_kwargs = dict(iou_thres=iou_thres, conf_thres=conf_thres, nms_thres=nms_thres, use_angle=use_angle, nms_mode=nms_mode,
+                                  pre_nms_topk=pre_nms_topk, pre_nms_topk_per_class=pre_nms_topk_per_class, max_det=max_det,
+                                  nms_timings=nms_timings)
+        pool = ThreadPoolExecutor(postprocess_workers) if postprocess_workers > 0 else None
+        max_in_flight = 2 * postprocess_workers
+        # (statistics or future of the statistics, labels) of the batches not yet in the accumulator
+        in_flight = collections.deque()
+        # img_paths = []  # Stores image paths
+        # img_detections = []  # Stores detections for each image index
+        val_acc_sum = 0 if compute_loss else None
+        val_loss_sum = 0 if compute_loss else None
+        num_batches = 0
+        batches = self.dataloader
+        if self.dataset.uint8_output:
+            # Workers return uint8 images, they are converted and normalized on the device
+            normalize = self.dataset.pixel_norm and self.dataset.normalize
+            mean, std = (self.dataset.mean_t, self.dataset.std_t) if normalize else (None, None)
+            batches = BatchPrefetcher(self.dataloader, device, mean=mean, std=std)
+        for batch_i, (path, imgs, targets) in enumerate(tqdm.tqdm(batches, desc="Detecting objects")):
+            num_batches += 1
+
+            if targets is None:
+                continue
+
+            if compute_loss:
+                in_targets = targets.detach().clone()
+                in_targets = in_targets.to(device)
+            # Extract labels
+            labels = targets[:, 1].numpy()
+            # Rescale target
+            targets[:, 2:6] = xywh2xyxy(targets[:, 2:6])
+            targets[:, [2, 4]] *= imgs.size(3)
+            targets[:, [3, 5]] *= imgs.size(2)
+
+            imgs = Variable(imgs.to(device), requires_grad=False)
+
+            with torch.no_grad():
+                if compute_loss:
+                    loss, outputs = model(imgs, targets=in_targets, use_angle=use_angle)
+                else:
+                    outputs = model(imgs, use_angle=use_angle)
+                # Cached before NMS, which converts the boxes in place
+                if cache is not None:
+                    cache.append(outputs, targets)
+
+            if compute_loss:
+                val_acc_batch = 0
+                for j, yolo in enumerate(model.yolo_layers):
+                    for name, metric in yolo.metrics.items():
+                        if name == "cls_acc":
+                            val_acc_batch += metric
+
+                # Accumulate loss for every batch of epoch
+                val_acc_sum += val_acc_batch / 3
+                val_loss_sum += loss.item()
+
+            if pool is not None:
+                in_flight.append((pool.submit(batch_statistics, outputs, targets, **postprocess_kwargs), labels))
+            else:
+                in_flight.append((batch_statistics(outputs, targets, **postprocess_kwargs), labels))
+            while len(in_flight) > max_in_flight:
+                _accumulate(ap_accumulator, *in_flight.popleft())
+            # # Save image paths and detections
+            # img_paths.extend(path)
+            # img_detections.extend(outputs)
+
+            # if batch_i == 19:
+            #         break
+
+        while in_flight:
+            _accumulate(ap_accumulator, *in_flight.popleft())
+        if pool is not None:
+            pool.shutdown()
+
+        if cache is not None:
+            cache.close(val_acc_sum=val_acc_sum if val_acc_sum is None else float(val_acc_sum),
+                        val_loss_sum=val_loss_sum if val_loss_sum is None else float(val_loss_sum), num_batches=num_batches)
+
+        return ap_accumulator, val_acc_sum, val_loss_sum, num_batches
+
+    def evaluate(self, model, iou_thres, conf_thres, nms_thres, compute_loss=True, **kwargs):
+        """
+        kwargs: further arguments of statistics (nms_mode, device, ...)
+        Returns the same as evaluate, validation accuracy and loss are None without compute_loss
+        """
+        ap_accumulator, val_acc_sum, val_loss_sum, num_batches = self.statistics(
+            model, iou_thres, conf_thres, nms_thres, compute_loss=compute_loss, **kwargs
+        )
+
+        # Calculat validation loss and accuracy
+        val_acc_epoch = epoch_mean(val_acc_sum, num_batches)
+        val_loss_epoch = epoch_mean(val_loss_sum, num_batches)
+        precision, recall, AP, f1, ap_class = ap_accumulator.compute()
+
+        return precision, recall, AP, f1, ap_class, val_acc_epoch, val_loss_epoch
+
+
+def epoch_mean(value_sum, num_batches):
+    """ Mean over the batches, None if the value was not computed """
+    return None if value_sum is None else value_sum / num_batches
+
+
+def evaluation_statistics(model, path, iou_thres, conf_thres, nms_thres, img_size, batch_size, use_angle, class_num, train_data=None,
+                          num_workers=4, shard=None, image_store=None, fast_letterbox=False, uint8_output=False, normalize=True, rect=False,
+                          **kwargs):
+    """
+    Evaluator.statistics on a one-off Evaluator of the validation list (or one shard of it)
+    kwargs: further arguments of Evaluator.statistics (compute_loss, nms_mode, device, cache_dir, ...)
+    """
+    evaluator = Evaluator(path, img_size, batch_size, use_angle, class_num, train_data=train_data, num_workers=num_workers, shard=shard,
+                          image_store=image_store, fast_letterbox=fast_letterbox, uint8_output=uint8_output, normalize=normalize, rect=rect)
+    return evaluator.statistics(model, iou_thres, conf_thres, nms_thres, **kwargs)
+
+
+def statistics_from_cache(cache, iou_thres, conf_thres, nms_thres, batch_size, use_angle, class_num, nms_mode="greedy",
+                          pre_nms_topk=None, pre_nms_topk_per_class=None, max_det=None, nms_timings=None, score_bins=1000):
+    """
+    Re-runs NMS and matching on cached raw predictions (see PredictionCache) without the model
+    The result is exact for conf_thres >= the floor of the cache, loss and accuracy are the ones of the cached run
+    Returns the same as evaluation_statistics
+    """
+    run_info = cache.load()
+    if conf_thres < cache.conf_floor:
+        raise ValueError(f"conf_thres {conf_thres} is below the floor {cache.conf_floor} of the cached predictions")
+
+    ap_accumulator = APAccumulator(class_num, num_bins=score_bins, num_thresholds=np.size(iou_thres))
+    for outputs, targets in tqdm.tqdm(cache.batches(batch_size), desc="Re-scoring cached predictions"):
+        statistics = batch_statistics(outputs, targets, iou_thres, conf_thres, nms_thres, use_angle, nms_timings=nms_timings, nms_mode=nms_mode,
+                                      pre_nms_topk=pre_nms_topk, pre_nms_topk_per_class=pre_nms_topk_per_class, max_det=max_det)
+        _accumulate(ap_accumulator, statistics, targets[:, 1].numpy())
+
+    return ap_accumulator, run_info["val_acc_sum"], run_info["val_loss_sum"], run_info["num_batches"]
 
-    Tensor = torch.cuda.FloatTensor if torch.cuda.is_available() else torch.FloatTensor
+
+def evaluate(model, path, json_path, iou_thres, conf_thres, nms_thres, img_size, batch_size, class_80, gpu_num, use_angle, class_num, train_data= None, nms_mode="greedy",
+             pre_nms_topk=None, pre_nms_topk_per_class=None, max_det=None, nms_timings=None, score_bins=1000, cache_dir=None, compute_loss=True):
     device = torch.device(f"cuda:{gpu_num}" if torch.cuda.is_available() else "cpu")
 
-    labels = []
-    sample_metrics = []  # List of tuples (TP, confs, pred)
-    # img_paths = []  # Stores image paths
-    # img_detections = []  # Stores detections for each image index
-    val_acc_epoch = 0
-    val_loss_epoch = 0
-    for batch_i, (path, imgs, targets) in enumerate(tqdm.tqdm(dataloader, desc="Detecting objects")):
-
-        if targets is None:
-            continue
-
-        in_targets = targets.detach().clone()
-        in_targets = in_targets.to(device)
-        # Extract labels
-        labels += targets[:, 1].tolist()
-        # Rescale target
-        targets[:, 2:6] = xywh2xyxy(targets[:, 2:6])
-        targets[:, 2:6] *= img_size
-
-        imgs = Variable(imgs.type(Tensor), requires_grad=False)
-
-        with torch.no_grad():
-            loss, outputs = model(imgs, targets=in_targets, use_angle=use_angle)
-            outputs = non_max_suppression(outputs, conf_thres=conf_thres, nms_thres=nms_thres, use_angle=use_angle)
-
-        val_acc_batch = 0
-        for j, yolo in enumerate(model.yolo_layers):
-            for name, metric in yolo.metrics.items():
-                if name == "cls_acc":
-                    val_acc_batch += metric
-
-        # Accumulate loss for every batch of epoch
-        val_acc_epoch += val_acc_batch / 3
-        val_loss_epoch += loss.item()
-
-        sample_metrics += get_batch_statistics(outputs, targets, iou_threshold=iou_thres, use_angle=use_angle)
-        # # Save image paths and detections
-        # img_paths.extend(path)
-        # img_detections.extend(outputs)
-
-        # if batch_i == 19:
-        #         break
+    ap_accumulator, val_acc_sum, val_loss_sum, num_batches = evaluation_statistics(
+        model, path, iou_thres, conf_thres, nms_thres, img_size, batch_size, use_angle, class_num, train_data=train_data,
+        nms_mode=nms_mode, pre_nms_topk=pre_nms_topk, pre_nms_topk_per_class=pre_nms_topk_per_class, max_det=max_det,
+        nms_timings=nms_timings, score_bins=score_bins, device=device, cache_dir=cache_dir, compute_loss=compute_loss,
+    )
 
     # Calculat validation loss and accuracy
-    val_acc_epoch = val_acc_epoch / (batch_i+1)
-    val_loss_epoch = val_loss_epoch / (batch_i+1)
-    # Concatenate sample statistics
-    true_positives, pred_scores, pred_labels = [np.concatenate(x, 0) for x in list(zip(*sample_metrics))]
-    precision, recall, AP, f1, ap_class = ap_per_class(true_positives, pred_scores, pred_labels, labels)
+    val_acc_epoch = epoch_mean(val_acc_sum, num_batches)
+    val_loss_epoch = epoch_mean(val_loss_sum, num_batches)
+    precision, recall, AP, f1, ap_class = ap_accumulator.compute()
 
     return precision, recall, AP, f1, ap_class, val_acc_epoch, val_loss_epoch    #, img_paths[:20], img_detections[:20]
 
 
+def _evaluation_shard_worker(model_def, img_size, state_dict, num_threads, shard, kwargs, results):
+    """ Evaluates one shard of the validation list on the CPU and puts the statistics and NMS timings in 'results' """
+    torch.set_num_threads(num_threads)
+    model = Darknet(model_def, img_size=img_size)
+    model.load_state_dict(state_dict)
+    statistics = evaluation_statistics(model, img_size=img_size, device=torch.device("cpu"), shard=shard, **kwargs)
+    results.put((shard[0], (statistics, kwargs["nms_timings"])))
+
+
+def sharded_evaluation_statistics(model, model_def, num_shards, threads_per_shard=None, loader_workers=1, nms_timings=None, **kwargs):
+    """
+    Splits the validation list in 'num_shards' interleaved shards, evaluates every shard in its own
+    CPU process and merges the statistics. The TP/FP counts only depend on the detections of each
+    image, so the merged mAP equals the serial result.
+    nms_timings: optional dict, the NMS timings of all shards are appended to it (see non_max_suppression),
+                 they are measured in processes running side by side on threads_per_shard threads each
+    kwargs: arguments of evaluation_statistics (path, iou_thres, conf_thres, nms_thres, img_size, ...)
+    Returns the same as evaluation_statistics
+    """
+    if threads_per_shard is None:
+        threads_per_shard = max(1, os.cpu_count() // num_shards)
+    img_size = kwargs.pop("img_size")
+    kwargs["num_workers"] = loader_workers
+    # Every shard collects its timings in its own dict
+    kwargs["nms_timings"] = {} if nms_timings is not None else None
+
+    # Weights are put in shared memory once instead of being copied to every process
+    state_dict = {name: value.detach().cpu().share_memory_() for name, value in model.state_dict().items()}
+
+    ctx = torch.multiprocessing.get_context("spawn")
+    results = ctx.SimpleQueue()
+    workers = [
+        ctx.Process(target=_evaluation_shard_worker, args=(model_def, img_size, state_dict, threads_per_shard, (i, num_shards), kwargs, results))
+        for i in range(num_shards)
+    ]
+    for worker in workers:
+        worker.start()
+    statistics = dict(results.get() for _ in workers)
+    for worker in workers:
+        worker.join()
+
+    if nms_timings is not None:
+        for i in range(num_shards):
+            for stage, values in statistics[i][1].items():
+                nms_timings.setdefault(stage, []).extend(values)
+
+    # Merge in shard order
+    ap_accumulator, val_acc_sum, val_loss_sum, num_batches = statistics[0][0]
+    for i in range(1, num_shards):
+        shard_accumulator, shard_acc_sum, shard_loss_sum, shard_batches = statistics[i][0]
+        ap_accumulator.merge(shard_accumulator)
+        if val_acc_sum is not None:
+            val_acc_sum += shard_acc_sum
+            val_loss_sum += shard_loss_sum
+        num_batches += shard_batches
+
+    return ap_accumulator, val_acc_sum, val_loss_sum, num_batches
+
+
+def evaluate_sharded(model, model_def, num_shards, threads_per_shard=None, loader_workers=1, **kwargs):
+    """
+    evaluate with the validation list split over 'num_shards' CPU processes (see sharded_evaluation_statistics)
+    Returns the same as evaluate
+    """
+    ap_accumulator, val_acc_sum, val_loss_sum, num_batches = sharded_evaluation_statistics(
+        model, model_def, num_shards, threads_per_shard=threads_per_shard, loader_workers=loader_workers, **kwargs
+    )
+
+    val_acc_epoch = epoch_mean(val_acc_sum, num_batches)
+    val_loss_epoch = epoch_mean(val_loss_sum, num_batches)
+    precision, recall, AP, f1, ap_class = ap_accumulator.compute()
+
+    return precision, recall, AP, f1, ap_class, val_acc_epoch, val_loss_epoch
+
+
+def _async_evaluation_worker(model_def, evaluator_kwargs, evaluate_kwargs, proxy_indices, num_threads, jobs, results):
+    """ Evaluates the (epoch, proxy, state_dict) jobs on the CPU until it receives None """
+    torch.set_num_threads(num_threads)
+    model = Darknet(model_def, img_size=evaluator_kwargs["img_size"])
+    # Full and proxy evaluators are created on first use
+    evaluators = {}
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        epoch, proxy, state_dict = job
+        model.load_state_dict(state_dict)
+        del state_dict, job
+        if proxy not in evaluators:
+            evaluators[proxy] = Evaluator(indices=proxy_indices if proxy else None, **evaluator_kwargs)
+        results.put((epoch, proxy, evaluators[proxy].evaluate(model, device=torch.device("cpu"), **evaluate_kwargs)))
+
+
+class AsyncEvaluator(object):
+    """
+    Evaluates snapshots of the weights in a separate CPU process while training goes on.
+    submit() hands over a CPU copy of the state_dict, poll() returns the finished
+    (epoch, proxy, evaluate results) in submission order. With proxy=True the snapshot is evaluated
+    on the 'proxy_indices' subset of the validation list. At most 'max_pending' snapshots are queued,
+    submit() waits for the oldest result beyond that, so no evaluation is dropped.
+    evaluator_kwargs: arguments of Evaluator (path, img_size, batch_size, use_angle, class_num, ...)
+    evaluate_kwargs: arguments of Evaluator.evaluate (iou_thres, conf_thres, nms_thres, ...)
+    """
+
+    def __init__(self, model_def, evaluator_kwargs, evaluate_kwargs, proxy_indices=None, num_threads=None, max_pending=2):
+        if num_threads is None:
+            num_threads = max(1, os.cpu_count() // 4)
+        self.max_pending = max_pending
+        self.pending = 0
+        self.finished = []
+
+        ctx = torch.multiprocessing.get_context("spawn")
+        self.jobs = ctx.Queue()
+        self.results = ctx.Queue()
+        self.worker = ctx.Process(target=_async_evaluation_worker,
+                                  args=(model_def, evaluator_kwargs, evaluate_kwargs, proxy_indices, num_threads, self.jobs, self.results))
+        self.worker.start()
+
+    def submit(self, epoch, model, proxy=False):
+        """ Queues the evaluation of the current weights of 'model' for 'epoch' """
+        while self.pending >= self.max_pending:
+            self._receive(block=True)
+        state_dict = {name: value.detach().cpu().clone() for name, value in model.state_dict().items()}
+        self.jobs.put((epoch, proxy, state_dict))
+        self.pending += 1
+
+    def _receive(self, block):
+        while True:
+            try:
+                self.finished.append(self.results.get(block=block, timeout=1 if block else None))
+                self.pending -= 1
+                return True
+            except queue.Empty:
+                if not self.worker.is_alive():
+                    raise RuntimeError(f"Evaluation worker stopped with exit code {self.worker.exitcode}")
+                if not block:
+                    return False
+
+    def poll(self):
+        """ Returns the list of (epoch, proxy, results) finished since the last call, without waiting """
+        while self.pending > 0 and self._receive(block=False):
+            pass
+        finished, self.finished = self.finished, []
+        return finished
+
+    def close(self):
+        """ Waits for the queued evaluations, stops the worker and returns the remaining results """
+        while self.pending > 0:
+            self._receive(block=True)
+        self.jobs.put(None)
+        self.worker.join()
+        finished, self.finished = self.finished, []
+        return finished
+
+
+def save_pr_curves(path, ap_accumulator, class_names, iou_thres):
+    """
+    Writes the precision-recall curve of every class to a csv file with one row per score bin:
+    class, name, conf, then precision and recall for every IoU threshold
+    """
+    iou_thres = np.atleast_1d(iou_thres)
+    with open(path, "w") as file:
+        file.write("class,name,conf," + ",".join(f"precision@{t:.2f},recall@{t:.2f}" for t in iou_thres) + "\n")
+        for c, (conf, precision, recall) in ap_accumulator.pr_curves().items():
+            for k in range(len(conf)):
+                values = ",".join(f"{precision[k, t]:.6f},{recall[k, t]:.6f}" for t in range(len(iou_thres)))
+                file.write(f"{c},{class_names[c]},{conf[k]:.4f},{values}\n")
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--batch_size", type=int, default=16, help="size of each image batch")
@@ -104,11 +452,31 @@ if __name__ == "__main__":
     parser.add_argument("--pretrained_weights", type=str, default="checkpoints/dst-fes/fda3norm_opt.pth", help="path to weights file")
     parser.add_argument("--class_path", type=str, default="data/class.names", help="path to class label file")
     parser.add_argument("--iou_thres", type=float, default=0.5, help="iou threshold required to qualify as detected")
+    parser.add_argument("--coco_map", action="store_true", help="report AP50, AP75 and AP[.5:.95] instead of AP at iou_thres")
     parser.add_argument("--conf_thres", type=float, default=0.5, help="object confidence threshold")
     parser.add_argument("--nms_thres", type=float, default=0.5, help="iou thresshold for non-maximum suppression")
+    parser.add_argument("--nms_mode", type=str, default="greedy", choices=["greedy", "fast", "cluster"], help="greedy NMS or matrix based Fast/Cluster NMS")
+    parser.add_argument("--pre_nms_topk", type=int, default=None, help="max number of candidates per image before NMS")
+    parser.add_argument("--pre_nms_topk_per_class", type=int, default=None, help="max number of candidates per class before NMS")
+    parser.add_argument("--max_det", type=int, default=None, help="max number of detections per image after NMS")
     parser.add_argument("--n_cpu", type=int, default=8, help="number of cpu threads to use during batch generation")
     parser.add_argument("--img_size", type=int, default=416, help="size of each image dimension")
     parser.add_argument("--use_angle", default=False, help='set flag to train using angle')
+    parser.add_argument("--num_shards", type=int, default=0, help="evaluate in this many CPU processes, each on a shard of the validation list "
+                        "(--nms_latency is gathered from all shards)")
+    parser.add_argument("--threads_per_shard", type=int, default=None, help="torch threads per shard process (default: cpu count / num_shards)")
+    parser.add_argument("--conf_sweep", type=float, nargs="+", default=None, help="report P/R/F1/AP for these confidence thresholds from one run at the lowest")
+    parser.add_argument("--pr_curves", type=str, default=None, help="csv file to write the per class precision-recall curves to")
+    parser.add_argument("--postprocess_workers", type=int, default=0, help="threads running NMS and matching while the next batches are forwarded "
+                        "(--nms_latency then includes contention with the forward pass)")
+    parser.add_argument("--nms_latency", action="store_true", help="time NMS per image (synchronizes the device) and report its latency")
+    parser.add_argument("--skip_loss", action="store_true", help="only compute the mAP, without validation loss and accuracy")
+    parser.add_argument("--image_store", type=str, default=None, help="image store of the validation list (see pack_images.py)")
+    parser.add_argument("--fast_letterbox", action="store_true", help="decode JPEGs at reduced scale and resize before padding")
+    parser.add_argument("--uint8_loading", action="store_true", help="workers return uint8 images, normalization runs on the device")
+    parser.add_argument("--fold_norm", action="store_true", help="fold the mean/std normalization into the first convolution, images are not normalized")
+    parser.add_argument("--rect", action="store_true", help="batch images of similar aspect ratio into rectangular inputs instead of squares")
+    parser.add_argument("--cache_dir", type=str, default=None, help="cache raw predictions here and re-score from the cache on later runs")
     #parser.add_argument('--train_dataset', type=str, default='dst', help='dataset on which model was trained')
     opt = parser.parse_args()
     print(opt)
@@ -167,28 +535,86 @@ if __name__ == "__main__":
         else:
             model.load_darknet_weights(opt.pretrained_weights)
 
+    if opt.fold_norm:
+        # The model takes [0, 1] images, the validation images are only decoded and letterboxed
+        norm_dataset = ListDataset(valid_path, use_angle=opt.use_angle, class_num=class_count, pixel_norm=True, train_data=train_dataset,
+                                   label_cache=False)
+        model.fold_input_normalization(norm_dataset.mean_t, norm_dataset.std_t)
+
     print("Compute mAP...")
+    nms_timings = {} if opt.nms_latency else None
 
-    precision, recall, AP, f1, ap_class, val_acc, val_loss, = evaluate(
-        model,
+    # With a confidence sweep NMS runs once at the lowest threshold, every other threshold is derived from its counts
+    statistics_kwargs = dict(
         path=valid_path,
-        json_path=valid_annpath,
-        iou_thres=opt.iou_thres,
-        conf_thres=opt.conf_thres,
+        iou_thres=COCO_IOU_THRESHOLDS if opt.coco_map else opt.iou_thres,
+        conf_thres=min(opt.conf_sweep) if opt.conf_sweep else opt.conf_thres,
         nms_thres=opt.nms_thres,
         img_size=opt.img_size,
         batch_size=opt.batch_size,
-        class_80=class_80,
-        gpu_num=device.index,
         train_data=train_dataset,
         use_angle=opt.use_angle,
-        class_num = class_count
+        class_num=class_count,
+        nms_mode=opt.nms_mode,
+        pre_nms_topk=opt.pre_nms_topk,
+        pre_nms_topk_per_class=opt.pre_nms_topk_per_class,
+        max_det=opt.max_det,
+        cache_dir=opt.cache_dir,
+        compute_loss=not opt.skip_loss,
+        postprocess_workers=opt.postprocess_workers,
+        image_store=opt.image_store,
+        fast_letterbox=opt.fast_letterbox,
+        uint8_output=opt.uint8_loading,
+        normalize=not opt.fold_norm,
+        rect=opt.rect,
     )
+    if opt.num_shards > 0:
+        ap_accumulator, val_acc_sum, val_loss_sum, num_batches = sharded_evaluation_statistics(
+            model, opt.model_def, opt.num_shards, threads_per_shard=opt.threads_per_shard, nms_timings=nms_timings,
+            **statistics_kwargs
+        )
+    else:
+        ap_accumulator, val_acc_sum, val_loss_sum, num_batches = evaluation_statistics(
+            model, device=device, nms_timings=nms_timings, **statistics_kwargs
+        )
+    val_acc = epoch_mean(val_acc_sum, num_batches)
+    val_loss = epoch_mean(val_loss_sum, num_batches)
+    precision, recall, AP, f1, ap_class = ap_accumulator.compute()
 
     print("Average Precisions:")
-    for i, c in enumerate(ap_class):
-        print(f"+ Class '{c}' ({class_names[c]}) - AP: {AP[i]}")
+    if opt.coco_map:
+        # Thresholds 0.5, 0.55, ..., 0.95: AP50 is column 0 and AP75 column 5
+        for i, c in enumerate(ap_class):
+            print(f"+ Class '{c}' ({class_names[c]}) - AP50: {AP[i, 0]}, AP75: {AP[i, 5]}, AP[.5:.95]: {AP[i].mean()}")
+
+        print(f"mAP50: {AP[:, 0].mean()}",
+                f"mAP75: {AP[:, 5].mean()}",
+                f"mAP[.5:.95]: {AP.mean()}",
+                f"val_acc: {val_acc}",
+                f"val_loss: {val_loss}")
+    else:
+        for i, c in enumerate(ap_class):
+            print(f"+ Class '{c}' ({class_names[c]}) - AP: {AP[i]}")
+
+        print(f"mAP: {AP.mean()}",
+                f"val_acc: {val_acc}",
+                f"val_loss: {val_loss}")
+
+    if opt.conf_sweep:
+        sweep_p, sweep_r, sweep_ap, sweep_f1, _ = ap_accumulator.sweep(opt.conf_sweep)
+        if opt.coco_map:
+            # Precision, recall and f1 at IoU 0.5, AP over [.5:.95]
+            sweep_p, sweep_r, sweep_f1, sweep_ap = sweep_p[..., 0], sweep_r[..., 0], sweep_f1[..., 0], sweep_ap.mean(2)
+        print("Confidence threshold sweep:")
+        for k, conf in enumerate(opt.conf_sweep):
+            print(f"+ conf {conf}: mP {sweep_p[:, k].mean():.4f}, mR {sweep_r[:, k].mean():.4f}, "
+                  f"mF1 {sweep_f1[:, k].mean():.4f}, mAP {sweep_ap[:, k].mean():.4f}")
+
+    if opt.pr_curves:
+        save_pr_curves(opt.pr_curves, ap_accumulator, class_names, statistics_kwargs["iou_thres"])
+        print(f"PR curves saved to {opt.pr_curves}")
 
-    print(f"mAP: {AP.mean()}",
-            f"val_acc: {val_acc}",
-            f"val_loss: {val_loss}")
+    if opt.nms_latency:
+        print("NMS latency per image (ms):")
+        for stage, mean, p50, p99, max_time in latency_summary(nms_timings):
+            print(f"+ {stage}: mean {mean:.3f}, p50 {p50:.3f}, p99 {p99:.3f}, max {max_time:.3f}")
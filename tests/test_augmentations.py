@@ -0,0 +1,30 @@
+import numpy as np
+import cv2
+import torch
+import imgaug.augmenters as iaa
+
+from utils.augmentations import BatchAug
+
+
+def hue(img):
+    """ OpenCV hue (0-179) of a uniform RGB uint8 image """
+    return int(cv2.cvtColor(np.ascontiguousarray(img[:1, :1]), cv2.COLOR_RGB2HSV)[0, 0, 0])
+
+
+def hue_distance(a, b):
+    return min((a - b) % 180, (b - a) % 180)
+
+
+def test_batch_aug_hue_matches_imgaug():
+    # Only the hue rotation: no brightness, no noise and a motion blur kernel of length 1
+    for value in (43, 85, 128, -85):
+        batch_aug = BatchAug(hue=(value, value), brightness=(0, 0), noise=(0, 0), blur_kernel=(1, 1))
+        for color in ((200, 60, 60), (60, 200, 60), (60, 60, 200), (220, 180, 40)):
+            img = np.full((8, 8, 3), color, dtype=np.uint8)
+            expected = hue(iaa.AddToHue(value=value)(image=img))
+
+            imgs = torch.from_numpy(img).permute(2, 0, 1).unsqueeze(0).float() / 255
+            out = batch_aug.photometric(imgs)[0].permute(1, 2, 0).numpy()
+            out = np.round(out * 255).astype(np.uint8)
+
+            assert hue_distance(hue(out), expected) <= 2, (value, color, hue(out), expected)
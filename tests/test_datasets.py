@@ -0,0 +1,69 @@
+import os
+
+import numpy as np
+
+from utils.datasets import stratified_subset, load_stratified_subset, letterbox_boxes
+from utils.utils import letterbox_geometry, rescale_boxes
+
+
+def domain_counts(img_files, indices, num_domains):
+    return sorted(np.bincount([int(os.path.basename(os.path.dirname(img_files[i]))) for i in indices], minlength=num_domains).tolist())
+
+
+def test_stratified_subset_spreads_uneven_remainders():
+    # Images without boxes all fall in class -1, so the strata are the domains
+    img_files = [f"data/{domain}/{i}.jpg" for domain in range(7) for i in range(100)]
+    indices = stratified_subset(img_files, np.zeros((0, 6)), np.zeros(len(img_files) + 1, dtype=int), 69)
+    assert len(indices) == 69
+    assert domain_counts(img_files, indices, 7) == [9] + [10] * 6
+
+    img_files = [f"data/{domain}/{i}.jpg" for domain in range(3) for i in range(100)]
+    indices = stratified_subset(img_files, np.zeros((0, 6)), np.zeros(len(img_files) + 1, dtype=int), 2)
+    assert domain_counts(img_files, indices, 3) == [0, 1, 1]
+
+
+
+def test_load_stratified_subset_rebuilds_when_labels_change(tmp_path):
+    img_files, label_files = [], []
+    for domain in range(2):
+        os.makedirs(tmp_path / str(domain))
+        for i in range(10):
+            img_files.append(str(tmp_path / str(domain) / f"{i}.jpg"))
+            label_files.append(str(tmp_path / str(domain) / f"{i}.txt"))
+            np.savetxt(label_files[-1], [[0, 0.5, 0.5, 0.1, 0.1, 0]])
+    list_path = tmp_path / "valid.txt"
+    list_path.write_text("\n".join(img_files) + "\n")
+
+    indices = load_stratified_subset(str(list_path), img_files, label_files, 4)
+    assert domain_counts(img_files, indices, 2) == [2, 2]
+
+    # Class 1 in one image of domain 1 makes it its own stratum, which has to be part of the subset
+    np.savetxt(label_files[11], [[1, 0.5, 0.5, 0.1, 0.1, 0]])
+    os.utime(label_files[11], ns=(0, 10 ** 18))
+    assert 11 in load_stratified_subset(str(list_path), img_files, label_files, 4)
+
+
+def test_load_stratified_subset_read_only_directory(tmp_path, monkeypatch):
+    img_files = [str(tmp_path / "0" / f"{i}.jpg") for i in range(10)]
+    label_files = [path.replace(".jpg", ".txt") for path in img_files]
+    list_path = tmp_path / "valid.txt"
+    list_path.write_text("\n".join(img_files) + "\n")
+
+    def read_only_open(path, mode="r", *args, **kwargs):
+        if "w" in mode:
+            raise PermissionError(13, "Read-only file system", path)
+        return builtins_open(path, mode, *args, **kwargs)
+
+    builtins_open = open
+    monkeypatch.setattr("builtins.open", read_only_open)
+    assert len(load_stratified_subset(str(list_path), img_files, label_files, 3)) == 3
+
+
+def test_rescale_boxes_inverts_the_letterbox():
+    boxes = np.array([[0, 37.0, 81.0, 20.0, 30.0, 0.0], [0, 301.5, 12.25, 5.0, 7.0, 0.0]])
+    for original_shape, current_dim in (((333, 517), (288, 416)), ((517, 333), 416), ((480, 640), (320, 416))):
+        (new_w, new_h), pad = letterbox_geometry(original_shape, current_dim)
+        letterboxed = letterbox_boxes(boxes, (new_w / original_shape[1], new_h / original_shape[0]), pad)
+        # Centers as (x1, y1, x2, y2) = (x, y, x, y)
+        centers = rescale_boxes(letterboxed[:, [1, 2, 1, 2]].copy(), current_dim, original_shape)
+        np.testing.assert_allclose(centers, boxes[:, [1, 2, 1, 2]], atol=1e-9)
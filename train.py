@@ -4,10 +4,10 @@ from models import *
 from utils.logger import *
 from utils.utils import *
 from utils.datasets import *
+from utils.augmentations import BatchAug
 from utils.parse_config import *
-from test import evaluate
+from test import Evaluator, AsyncEvaluator
 from detect import draw_bbox
-from itertools import cycle
 
 from terminaltables import AsciiTable
 
@@ -41,6 +41,32 @@ def adjust_learning_rate(optimizer, epoch):
         print(lr)
 
 
+def log_evaluation(logger, class_names, epoch, results, proxy=False):
+    """
+    Logs the results of test.evaluate to the step of the evaluated epoch and prints the class APs
+    proxy: results of the validation subset, logged with a 'proxy_' prefix
+    """
+    prefix = "proxy_" if proxy else ""
+    precision, recall, AP, f1, ap_class, val_acc, val_loss = results
+    evaluation_metrics = [
+        (f"{prefix}val_precision", precision.mean()),
+        (f"{prefix}val_recall", recall.mean()),
+        (f"{prefix}val_mAP", AP.mean()),
+        (f"{prefix}val_f1", f1.mean()),
+    ]
+    logger.val_list_of_scalars_summary(evaluation_metrics, epoch)
+    if val_loss is not None:
+        logger.val_scalar_summary(f"{prefix}epoch_acc", val_acc, epoch)
+        logger.val_scalar_summary(f"{prefix}epoch_loss", val_loss, epoch)
+    # Print class APs and mAP
+    ap_table = [["Index", "Class name", "AP"]]
+    for i, c in enumerate(ap_class):
+        ap_table += [[c, class_names[c], "%.5f" % AP[i]]]
+    print(f"---- {'Proxy evaluation' if proxy else 'Evaluation'} of epoch {epoch} ----")
+    print(AsciiTable(ap_table).table)
+    print(f"---- mAP {AP.mean()}")
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--epochs", type=int, default=100, help="number of epochs")
@@ -56,13 +82,26 @@ if __name__ == "__main__":
     parser.add_argument("--evaluation_interval", type=int, default=1, help="interval evaluations on validation set")
     parser.add_argument("--compute_map", default=False, help="if True computes mAP every tenth batch")
     parser.add_argument("--multiscale_training", default=False, help="allow for multi-scale training")
+    parser.add_argument("--multiscale_seed", type=int, default=0, help="seed of the multi-scale size schedule")
     parser.add_argument("--use_angle", default=False, help='set flag to train using angle')
     parser.add_argument("--uda_method", default=None, choices=['minent', 'fda'], help="select the domain adaptation method")
     parser.add_argument("--train_data", default=None, choices=['theo_cep', 'imagenet'], help="use the flag to overwrite default parameter or when using UDA method")
+    parser.add_argument("--target_seed", type=int, default=0, help="seed of the target domain shuffling")
     parser.add_argument("--warmup_iter", default=0, type=int, help="specify number of iterations to train before starting with UDA")
     parser.add_argument("--beta", type=float, default=0.01, choices=[0.1, 0.01, 0.05, 0.005], help="factor to select size of mask. Should be between 0 and 1" )
     parser.add_argument("--circle_mask", type=bool, default=False, help="to select the circular mask. Default mask is square")
     parser.add_argument("--augment", type=bool, default=False )
+    parser.add_argument("--async_eval", action="store_true", help="evaluate in a background CPU process while training continues")
+    parser.add_argument("--async_eval_threads", type=int, default=None, help="torch threads of the background evaluation (default: cpu count / 4)")
+    parser.add_argument("--batch_aug", action="store_true", help="augment whole batches on the training device instead of per image in the workers")
+    parser.add_argument("--warp_aug", action="store_true", help="with --augment, augment, pad and resize every image with one affine warp (WarpAug)")
+    parser.add_argument("--uint8_loading", action="store_true", help="workers return uint8 images, conversion and normalization run on the device")
+    parser.add_argument("--train_store", type=str, default=None, help="image store of the training list (see pack_images.py)")
+    parser.add_argument("--valid_store", type=str, default=None, help="image store of the validation list (see pack_images.py)")
+    parser.add_argument("--proxy_eval_size", type=int, default=0, help="evaluate on a stratified subset of this many validation images")
+    parser.add_argument("--proxy_eval_seed", type=int, default=0, help="seed of the proxy validation subset")
+    parser.add_argument("--full_eval_interval", type=int, default=10, help="with a proxy subset, interval of evaluations on the full validation set")
+    parser.add_argument("--skip_val_loss", action="store_true", help="evaluate mAP only, without validation loss and accuracy")
     opt = parser.parse_args()
     print(opt)
 
@@ -122,7 +161,7 @@ if __name__ == "__main__":
     model.apply(weights_init_normal)
 
     # If specified we start from checkpoint
-    
+    checkpoint = {}
     if opt.pretrained_weights:
         if opt.pretrained_weights.endswith(".pth"):
             checkpoint = torch.load(opt.pretrained_weights, map_location=lambda storage, loc:storage )  #map_location=f'cuda:{device.index}'
@@ -143,17 +182,32 @@ if __name__ == "__main__":
     # scheduler = lr_scheduler.MultiStepLR(optimizer, milestones=[7,10,15], gamma=0.5)
 
     # Get dataloader
-    dataset = ListDataset(train_path, augment=opt.augment, multiscale=opt.multiscale_training, normalized_labels=False, 
+    # With batch_aug the workers only decode, augmentation and normalization run on the device
+    dataset = ListDataset(train_path, augment=opt.augment and not opt.batch_aug, multiscale=opt.multiscale_training, normalized_labels=False, 
                     pixel_norm=True, train_data=train_dataset, use_angle=opt.use_angle, class_num= class_count, 
-                    uda_method=opt.uda_method, beta=opt.beta, circular=opt.circle_mask)
+                    uda_method=opt.uda_method, beta=opt.beta, circular=opt.circle_mask, image_store=opt.train_store,
+                    normalize=not opt.batch_aug, warp_aug=opt.warp_aug, uint8_output=opt.uint8_loading)
+    if opt.batch_aug:
+        batch_aug = BatchAug(mean=dataset.mean_t, std=dataset.std_t, use_angle=opt.use_angle)
+    if opt.multiscale_training:
+        # One size schedule for all workers, a new size every 10 batches
+        batch_sampler = MultiscaleBatchSampler(torch.utils.data.RandomSampler(dataset), opt.batch_size, False,
+                                               dataset.min_size, dataset.max_size, seed=opt.multiscale_seed)
+        loader_kwargs = dict(batch_sampler=batch_sampler)
+    else:
+        loader_kwargs = dict(batch_size=opt.batch_size, shuffle=True)
     dataloader = torch.utils.data.DataLoader(
         dataset,
-        batch_size=opt.batch_size,
-        shuffle=True,
         num_workers=opt.n_cpu,
         pin_memory=True,
         collate_fn=dataset.collate_fn,
+        **loader_kwargs,
     )
+    train_batches = dataloader
+    if opt.uint8_loading:
+        # With batch_aug the images are only scaled to [0, 1], BatchAug normalizes after augmenting
+        train_batches = BatchPrefetcher(dataloader, device, mean=None if opt.batch_aug else dataset.mean_t,
+                                        std=None if opt.batch_aug else dataset.std_t)
     print('Loaded Training dataset')
 
     metrics = [
@@ -178,17 +232,38 @@ if __name__ == "__main__":
     if opt.uda_method == 'minent' or opt.uda_method == 'fda':
         # Get dataloader for target domains
         target_dataset = ImageFolder(folder_path=targetdomain_path, train_data=train_dataset, augment=True)
-        targetloader = torch.utils.data.DataLoader(
-            target_dataset, 
-            batch_size=opt.batch_size,
-            shuffle=True,
-            num_workers=opt.n_cpu,
-            pin_memory=True,
-        )
+        # Reshuffled on every pass, continues from its position in the checkpoint when resuming
+        target_stream = InfiniteBatchStream(target_dataset, opt.batch_size, num_workers=opt.n_cpu, seed=opt.target_seed, pin_memory=True)
+        if 'target_stream' in checkpoint:
+            target_stream.load_state_dict(checkpoint['target_stream'])
         print("Loaded Target dataset")
-        targetloader_iter = enumerate( cycle(targetloader) )
+
+    # Fixed stratified subset of the validation list for the per epoch proxy mAP, taken from the
+    # checkpoint when resuming so the proxy results stay comparable
+    proxy_indices = None
+    if opt.proxy_eval_size:
+        proxy_indices = checkpoint.get('proxy_eval_indices')
+        if proxy_indices is None:
+            valid_dataset = ListDataset(valid_path, use_angle=opt.use_angle, class_num=class_count)
+            proxy_indices = load_stratified_subset(valid_path, valid_dataset.img_files, valid_dataset.label_files,
+                                                   opt.proxy_eval_size, seed=opt.proxy_eval_seed)
+        print(f"Proxy evaluation on {len(proxy_indices)} validation images, full evaluation every {opt.full_eval_interval} epochs")
+
+    # Validation dataset and workers are kept for the evaluations of all epochs
+    evaluator_kwargs = dict(path=valid_path, img_size=opt.img_size, batch_size=opt.batch_size, use_angle=opt.use_angle,
+                            class_num=class_count, train_data=train_dataset, image_store=opt.valid_store,
+                            uint8_output=opt.uint8_loading)
+    evaluate_kwargs = dict(iou_thres=0.5, conf_thres=0.5, nms_thres=0.5, compute_loss=not opt.skip_val_loss)
+    if opt.async_eval:
+        async_evaluator = AsyncEvaluator(opt.model_def, evaluator_kwargs, evaluate_kwargs, proxy_indices=proxy_indices,
+                                         num_threads=opt.async_eval_threads)
+    else:
+        # Created on first use
+        evaluators = {}
 
     for epoch in range(opt.epochs):
+        if opt.multiscale_training:
+            batch_sampler.set_epoch(epoch)
         ### Use lr_scheduler
         #adjust_learning_rate(optimizer,epoch)
 
@@ -196,15 +271,16 @@ if __name__ == "__main__":
         start_time = time.time()
         train_acc_epoch = 0
         train_loss_epoch = 0
-        for batch_i, (_, imgs, targets) in enumerate(dataloader):
+        for batch_i, (_, imgs, targets) in enumerate(train_batches):
             batches_done = len(dataloader) * epoch + batch_i
 
             imgs = Variable(imgs.to(device))
             targets = Variable(targets.to(device), requires_grad=False)
+            if opt.batch_aug:
+                imgs, targets = batch_aug(imgs, targets)
 
             if opt.uda_method == 'fda':
-                _, batch_uda = targetloader_iter.__next__()
-                images_paths, images_uda = batch_uda
+                images_paths, images_uda = next(target_stream)
                 images_uda = Variable(images_uda.to(device))
 
                 imgs = FDA_source_to_target(imgs, images_uda, L=opt.beta, use_circular=opt.circle_mask)
@@ -214,8 +290,7 @@ if __name__ == "__main__":
 
             if epoch >= opt.warmup_iter:
                 if opt.uda_method == 'minent':
-                    _, batch_uda = targetloader_iter.__next__()
-                    images_paths, images_uda = batch_uda
+                    images_paths, images_uda = next(target_stream)
                     images_uda = Variable(images_uda.to(device))
 
                     loss_uda, outputs_uda = model(images_uda, uda_method=opt.uda_method)
@@ -314,47 +389,36 @@ if __name__ == "__main__":
 
         if epoch % opt.checkpoint_interval == 0:
             model.eval()
-            torch.save({
+            state = {
                     'model_state_dict': model.state_dict(),
                     'optimizer_state_dict': optimizer.state_dict(),
                     'epoch': epoch,
                     'loss':  loss,
-                    },f"checkpoints/yolov3_ckpt_opt_{gpu_no}_{train_dataset}_%d.pth" % epoch)
+                    'proxy_eval_indices': proxy_indices,
+                    }
+            if opt.uda_method == 'minent' or opt.uda_method == 'fda':
+                state['target_stream'] = target_stream.state_dict()
+            torch.save(state, f"checkpoints/yolov3_ckpt_opt_{gpu_no}_{train_dataset}_%d.pth" % epoch)
 
         if epoch % opt.evaluation_interval == 0:
             if epoch >= 0:
-                print("\n---- Evaluating Model ----")
-                # Evaluate the model on the validation set
-                precision, recall, AP, f1, ap_class, val_acc, val_loss = evaluate(
-                    model,
-                    path=valid_path,
-                    json_path=valid_annpath,
-                    iou_thres=0.5,
-                    conf_thres=0.5,
-                    nms_thres=0.5,
-                    img_size=opt.img_size,
-                    batch_size=opt.batch_size,
-                    class_80=class_80,
-                    gpu_num=gpu_no,
-                    train_data= train_dataset,
-                    use_angle=opt.use_angle,
-                    class_num = class_count
-                )
-                evaluation_metrics = [
-                    ("val_precision", precision.mean()),
-                    ("val_recall", recall.mean()),
-                    ("val_mAP", AP.mean()),
-                    ("val_f1", f1.mean()),
-                ]
-                logger.val_list_of_scalars_summary(evaluation_metrics, epoch)
-                logger.val_scalar_summary("epoch_acc", val_acc, epoch)
-                logger.val_scalar_summary("epoch_loss", val_loss, epoch)
-                # Print class APs and mAP
-                ap_table = [["Index", "Class name", "AP"]]
-                for i, c in enumerate(ap_class):
-                    ap_table += [[c, class_names[c], "%.5f" % AP[i]]]
-                print(AsciiTable(ap_table).table)
-                print(f"---- mAP {AP.mean()}")
+                # Proxy subset every evaluation, the full list every full_eval_interval epochs
+                proxy = proxy_indices is not None and epoch % opt.full_eval_interval != 0
+                if opt.async_eval:
+                    # Evaluated in the background, the results are logged to this epoch when they arrive
+                    print(f"\n---- Queued evaluation of epoch {epoch} ----")
+                    async_evaluator.submit(epoch, model, proxy=proxy)
+                else:
+                    print("\n---- Evaluating Model ----")
+                    if proxy not in evaluators:
+                        evaluators[proxy] = Evaluator(indices=proxy_indices if proxy else None, **evaluator_kwargs)
+                    # Evaluate the model on the validation set
+                    results = evaluators[proxy].evaluate(
+                        model,
+                        device=device,
+                        **evaluate_kwargs,
+                    )
+                    log_evaluation(logger, class_names, epoch, results, proxy=proxy)
 
             #model.save_darknet_weights(f"checkpoints/darknet_ckpt_%d.pth" % epoch)
 
@@ -367,3 +431,12 @@ if __name__ == "__main__":
                 #         nms_thres=0.8,
                 #         n_cpu=opt.n_cpu,
                 #         out_dir='training')
+
+        if opt.async_eval:
+            for eval_epoch, proxy, results in async_evaluator.poll():
+                log_evaluation(logger, class_names, eval_epoch, results, proxy=proxy)
+
+    if opt.async_eval:
+        # Results of the last queued epochs
+        for eval_epoch, proxy, results in async_evaluator.close():
+            log_evaluation(logger, class_names, eval_epoch, results, proxy=proxy)
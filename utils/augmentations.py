@@ -1,3 +1,8 @@
+import math
+import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
 import imgaug.augmenters as iaa
 from utils.transforms import ImgAug
 
@@ -14,4 +19,299 @@ class DefaultAug(ImgAug):
             iaa.AdditiveGaussianNoise(scale=(0,8)),
             iaa.MotionBlur(k=(3,10), angle=(-90,90)),
             iaa.Crop(percent=(0.0,0.3))
-        ], random_order=False)
\ No newline at end of file
+        ], random_order=False)
+
+
+class BatchAug(object):
+    """
+    DefaultAug on a whole collated batch on its device, so the dataloader workers only decode.
+    The geometric steps (affine, horizontal flip, crop) are composed into one matrix per sample and
+    applied with a single grid_sample, the boxes are transformed with the same matrices.
+    Brightness, hue, noise and motion blur are batched tensor ops.
+    Input images are in [0, 1] and not normalized (ListDataset(normalize=False)), the per channel
+    mean/std normalization is applied at the end.
+    Without use_angle boxes become the enclosing box of the transformed box like in imgaug, with
+    use_angle the center and the two half axes of the rotated box are transformed (the crop scales
+    x and y differently, the resulting parallelogram is approximated by the rectangle of its axes).
+    """
+
+    def __init__(self, mean=None, std=None, use_angle='False', rotate=(-45, 45), scale=(0.8, 1.3), translate=(-0.2, 0.2),
+                 brightness=(-100, 100), hue=(-128, 128), flip=0.5, noise=(0, 8), blur_kernel=(3, 10), blur_angle=(-90, 90),
+                 crop=(0.0, 0.3)):
+        self.mean = mean
+        self.std = std
+        self.use_angle = use_angle
+        self.rotate = rotate
+        self.scale = scale
+        self.translate = translate
+        self.brightness = brightness
+        self.hue = hue
+        self.flip = flip
+        self.noise = noise
+        self.blur_kernel = blur_kernel
+        self.blur_angle = blur_angle
+        self.crop = crop
+
+    def __call__(self, imgs, targets):
+        """
+        imgs: (batch_size, 3, H, W) in [0, 1]
+        targets: (sample_index, label, x, y, w, h, angle) relative to the image size, or None
+        Returns the augmented and normalized images and the transformed targets
+        """
+        matrices = self.geometric_matrices(imgs.size(0), imgs.size(2), imgs.size(3), imgs.device)
+        imgs = self.warp(imgs, matrices)
+        if targets is not None and len(targets):
+            targets = self.transform_targets(targets, matrices, imgs.size(2), imgs.size(3))
+        imgs = self.photometric(imgs)
+
+        if self.mean is not None:
+            mean = torch.tensor(self.mean, dtype=imgs.dtype, device=imgs.device).view(1, -1, 1, 1)
+            std = torch.tensor(self.std, dtype=imgs.dtype, device=imgs.device).view(1, -1, 1, 1)
+            imgs = (imgs - mean) / std
+        return imgs, targets
+
+    @staticmethod
+    def _uniform(value_range, n, device):
+        return torch.empty(n, device=device).uniform_(*value_range)
+
+    def geometric_matrices(self, batch_size, height, width, device):
+        """ (batch_size, 3, 3) input to output pixel matrices of crop . flip . affine """
+        eye = torch.eye(3, device=device).repeat(batch_size, 1, 1)
+
+        # Rotation and scale about the image center, then translation
+        angle = self._uniform(self.rotate, batch_size, device) * math.pi / 180
+        scale = self._uniform(self.scale, batch_size, device)
+        cos, sin = torch.cos(angle) * scale, torch.sin(angle) * scale
+        tx = self._uniform(self.translate, batch_size, device) * width
+        ty = self._uniform(self.translate, batch_size, device) * height
+        cx, cy = width / 2, height / 2
+        affine = eye.clone()
+        affine[:, 0, 0], affine[:, 0, 1], affine[:, 0, 2] = cos, -sin, cx - cos * cx + sin * cy + tx
+        affine[:, 1, 0], affine[:, 1, 1], affine[:, 1, 2] = sin, cos, cy - sin * cx - cos * cy + ty
+
+        # Horizontal flip
+        flip = eye.clone()
+        flipped = torch.rand(batch_size, device=device) < self.flip
+        flip[flipped, 0, 0] = -1
+        flip[flipped, 0, 2] = width
+
+        # Crop of every side, resized back to the image size
+        left, right, top, bottom = (self._uniform(self.crop, batch_size, device) for _ in range(4))
+        crop = eye.clone()
+        crop[:, 0, 0] = 1 / (1 - left - right)
+        crop[:, 0, 2] = -left * width / (1 - left - right)
+        crop[:, 1, 1] = 1 / (1 - top - bottom)
+        crop[:, 1, 2] = -top * height / (1 - top - bottom)
+
+        return crop @ flip @ affine
+
+    @staticmethod
+    def warp(imgs, matrices):
+        """ One bilinear resampling of every image with its pixel matrix """
+        height, width = imgs.shape[2:]
+        # Pixel to grid_sample coordinates (align_corners=False)
+        to_grid = torch.tensor([[2 / width, 0, -1], [0, 2 / height, -1], [0, 0, 1]], dtype=matrices.dtype, device=matrices.device)
+        # grid_sample maps output to input coordinates
+        theta = to_grid @ torch.inverse(matrices) @ torch.inverse(to_grid)
+        grid = F.affine_grid(theta[:, :2].to(imgs.dtype), list(imgs.shape), align_corners=False)
+        return F.grid_sample(imgs, grid, mode="bilinear", padding_mode="zeros", align_corners=False)
+
+    def transform_targets(self, targets, matrices, height, width):
+        """ Transforms the relative (x, y, w, h, angle) targets and removes the boxes outside the image """
+        targets = targets.clone()
+        m = matrices[targets[:, 0].long()].to(targets.dtype)
+        linear = m[:, :2, :2]
+
+        center = torch.stack((targets[:, 2] * width, targets[:, 3] * height), 1)
+        center = (linear @ center.unsqueeze(2)).squeeze(2) + m[:, :2, 2]
+        # Half axes of the (rotated) box
+        angle = targets[:, 6] * math.pi / 180
+        cos, sin = torch.cos(angle), torch.sin(angle)
+        half_w = (targets[:, 4] * width / 2).unsqueeze(1) * torch.stack((cos, sin), 1)
+        half_h = (targets[:, 5] * height / 2).unsqueeze(1) * torch.stack((-sin, cos), 1)
+        half_w = (linear @ half_w.unsqueeze(2)).squeeze(2)
+        half_h = (linear @ half_h.unsqueeze(2)).squeeze(2)
+
+        if self.use_angle == 'True':
+            box_w, box_h = 2 * half_w.norm(dim=1), 2 * half_h.norm(dim=1)
+            box_angle = torch.atan2(half_w[:, 1], half_w[:, 0]) * 180 / math.pi
+            # Same rectangle after a half turn, angles stay in [-90, 90)
+            box_angle = (box_angle + 90) % 180 - 90
+            keep = (center[:, 0] >= 0) & (center[:, 0] < width) & (center[:, 1] >= 0) & (center[:, 1] < height)
+        else:
+            # Enclosing box of the transformed corners, clipped to the image
+            extent_x = half_w[:, 0].abs() + half_h[:, 0].abs()
+            extent_y = half_w[:, 1].abs() + half_h[:, 1].abs()
+            x1, x2 = (center[:, 0] - extent_x).clamp(0, width), (center[:, 0] + extent_x).clamp(0, width)
+            y1, y2 = (center[:, 1] - extent_y).clamp(0, height), (center[:, 1] + extent_y).clamp(0, height)
+            center = torch.stack(((x1 + x2) / 2, (y1 + y2) / 2), 1)
+            box_w, box_h, box_angle = x2 - x1, y2 - y1, targets[:, 6]
+            keep = (box_w > 0) & (box_h > 0)
+
+        targets[:, 2] = center[:, 0] / width
+        targets[:, 3] = center[:, 1] / height
+        targets[:, 4] = box_w / width
+        targets[:, 5] = box_h / height
+        targets[:, 6] = box_angle
+        return targets[keep]
+
+    def photometric(self, imgs):
+        """ Brightness, hue, gaussian noise and motion blur with per sample parameters """
+        batch_size, device = imgs.size(0), imgs.device
+
+        # Adding to Y of YCrCb shifts every RGB channel by the same amount
+        imgs = imgs + self._uniform(self.brightness, batch_size, device).view(-1, 1, 1, 1) / 255
+
+        # Hue: rotation of the colors about the gray axis, +-255 is a full turn like AddToHue
+        angle = self._uniform(self.hue, batch_size, device) / 255 * 2 * math.pi
+        axis = torch.full((3,), 3 ** -0.5, device=device)
+        cross = torch.tensor([[0, -1, 1], [1, 0, -1], [-1, 1, 0]], dtype=imgs.dtype, device=device) * 3 ** -0.5
+        rotation = (torch.cos(angle).view(-1, 1, 1) * torch.eye(3, device=device)
+                    + (1 - torch.cos(angle)).view(-1, 1, 1) * torch.ger(axis, axis)
+                    + torch.sin(angle).view(-1, 1, 1) * cross)
+        imgs = torch.einsum("bij,bjhw->bihw", rotation, imgs).clamp(0, 1)
+
+        # Gaussian noise, the same for every channel
+        noise_scale = self._uniform(self.noise, batch_size, device).view(-1, 1, 1, 1) / 255
+        imgs = imgs + torch.randn_like(imgs[:, :1]) * noise_scale
+
+        imgs = self.motion_blur(imgs)
+        return imgs.clamp(0, 1)
+
+    def motion_blur(self, imgs):
+        """ Line kernel of random length and direction per sample, applied as one grouped convolution """
+        batch_size, channels, height, width = imgs.shape
+        device = imgs.device
+        length = torch.randint(self.blur_kernel[0], self.blur_kernel[1] + 1, (batch_size,), device=device).float()
+        angle = self._uniform(self.blur_angle, batch_size, device) * math.pi / 180
+
+        size = self.blur_kernel[1] // 2 * 2 + 1
+        offsets = torch.arange(size, device=device, dtype=imgs.dtype) - size // 2
+        y, x = torch.meshgrid(offsets, offsets)
+        cos, sin = torch.cos(angle).view(-1, 1, 1), torch.sin(angle).view(-1, 1, 1)
+        along = (x * cos + y * sin).abs()
+        across = (-x * sin + y * cos).abs()
+        kernel = ((across <= 0.5) & (along <= (length.view(-1, 1, 1) - 1) / 2)).to(imgs.dtype)
+        kernel = kernel / kernel.sum((1, 2), keepdim=True)
+
+        kernel = kernel.repeat_interleave(channels, 0).unsqueeze(1)
+        padded = F.pad(imgs.reshape(1, batch_size * channels, height, width), [size // 2] * 4, mode="replicate")
+        return F.conv2d(padded, kernel, groups=batch_size * channels).view(batch_size, channels, height, width)
+
+
+class WarpAug(object):
+    """
+    DefaultAug for one (img, boxes) sample with a single resampling: affine, horizontal flip, crop,
+    pad to square and resize to img_size are composed into one 2x3 matrix applied with
+    cv2.warpAffine, the boxes (and with use_angle their angles) go through the same matrix.
+    Brightness and hue are uint8 lookup tables, followed by gaussian noise and motion blur.
+    img: (h, w, 3) uint8, boxes: (label, x, y, w, h, angle) in pixels
+    Returns the (img_size, img_size, 3) image and the boxes in its pixels, replaces
+    DefaultAug + PadSquare + resize in collate_fn
+    """
+
+    def __init__(self, img_size=416, use_angle='False', rotate=(-45, 45), scale=(0.8, 1.3), translate=(-0.2, 0.2),
+                 brightness=(-100, 100), hue=(-128, 128), flip=0.5, noise=(0, 8), blur_kernel=(3, 10), blur_angle=(-90, 90),
+                 crop=(0.0, 0.3)):
+        self.img_size = img_size
+        self.use_angle = use_angle
+        self.rotate = rotate
+        self.scale = scale
+        self.translate = translate
+        self.brightness = brightness
+        self.hue = hue
+        self.flip = flip
+        self.noise = noise
+        self.blur_kernel = blur_kernel
+        self.blur_angle = blur_angle
+        self.crop = crop
+
+    def matrix(self, height, width):
+        """ 3x3 matrix from original pixels to output pixels: resize . pad . crop . flip . affine """
+        angle = np.radians(np.random.uniform(*self.rotate))
+        scale = np.random.uniform(*self.scale)
+        cos, sin = np.cos(angle) * scale, np.sin(angle) * scale
+        tx = np.random.uniform(*self.translate) * width
+        ty = np.random.uniform(*self.translate) * height
+        cx, cy = width / 2, height / 2
+        affine = np.array([[cos, -sin, cx - cos * cx + sin * cy + tx],
+                           [sin, cos, cy - sin * cx - cos * cy + ty],
+                           [0, 0, 1]])
+
+        flip = np.eye(3)
+        if np.random.rand() < self.flip:
+            flip[0, 0], flip[0, 2] = -1, width
+
+        # Crop of every side, resized back to the image size
+        left, right, top, bottom = np.random.uniform(*self.crop, size=4)
+        crop = np.array([[1 / (1 - left - right), 0, -left * width / (1 - left - right)],
+                         [0, 1 / (1 - top - bottom), -top * height / (1 - top - bottom)],
+                         [0, 0, 1]])
+
+        # Pad to square (centered like PadSquare) and resize to img_size
+        side = max(height, width)
+        letterbox = np.array([[self.img_size / side, 0, (side - width) // 2 * self.img_size / side],
+                              [0, self.img_size / side, (side - height) // 2 * self.img_size / side],
+                              [0, 0, 1]])
+
+        return letterbox @ crop @ flip @ affine
+
+    def transform_boxes(self, boxes, matrix):
+        """ Boxes in output pixels, boxes outside the output image are removed """
+        linear = matrix[:2, :2]
+        center = boxes[:, 1:3] @ linear.T + matrix[:2, 2]
+        angle = np.radians(boxes[:, 5])
+        cos, sin = np.cos(angle), np.sin(angle)
+        half_w = (boxes[:, 3:4] / 2 * np.stack((cos, sin), 1)) @ linear.T
+        half_h = (boxes[:, 4:5] / 2 * np.stack((-sin, cos), 1)) @ linear.T
+
+        size = self.img_size
+        boxes = boxes.copy()
+        if self.use_angle == 'True':
+            boxes[:, 3] = 2 * np.linalg.norm(half_w, axis=1)
+            boxes[:, 4] = 2 * np.linalg.norm(half_h, axis=1)
+            # Same rectangle after a half turn, angles stay in [-90, 90)
+            boxes[:, 5] = (np.degrees(np.arctan2(half_w[:, 1], half_w[:, 0])) + 90) % 180 - 90
+            keep = (center >= 0).all(1) & (center < size).all(1)
+        else:
+            # Enclosing box of the transformed corners, clipped to the image
+            extent = np.abs(half_w) + np.abs(half_h)
+            low, high = np.clip(center - extent, 0, size), np.clip(center + extent, 0, size)
+            center = (low + high) / 2
+            boxes[:, 3:5] = high - low
+            keep = (boxes[:, 3] > 0) & (boxes[:, 4] > 0)
+        boxes[:, 1:3] = center
+        return boxes[keep]
+
+    def photometric(self, img):
+        """ Brightness and hue with lookup tables, then gaussian noise and motion blur """
+        # Adding to Y of YCrCb shifts every RGB channel by the same amount
+        values = np.arange(256)
+        img = cv2.LUT(img, np.clip(values + np.random.uniform(*self.brightness), 0, 255).astype(np.uint8))
+
+        # Hue of OpenCV HSV is 0-179, +-255 is a full turn like AddToHue
+        hue_shift = np.random.uniform(*self.hue) / 255 * 180
+        hsv = cv2.cvtColor(img, cv2.COLOR_RGB2HSV)
+        hsv[..., 0] = cv2.LUT(hsv[..., 0], (np.round(values + hue_shift) % 180).astype(np.uint8))
+        img = cv2.cvtColor(hsv, cv2.COLOR_HSV2RGB)
+
+        # Gaussian noise, the same for every channel
+        noise = np.random.randn(*img.shape[:2], 1) * np.random.uniform(*self.noise)
+        img = np.clip(img + noise, 0, 255).astype(np.uint8)
+
+        # Motion blur with a line kernel
+        length = np.random.randint(self.blur_kernel[0], self.blur_kernel[1] + 1)
+        angle = np.radians(np.random.uniform(*self.blur_angle))
+        offsets = np.arange(length // 2 * 2 + 1) - length // 2
+        x, y = np.meshgrid(offsets, offsets)
+        kernel = ((np.abs(-x * np.sin(angle) + y * np.cos(angle)) <= 0.5)
+                  & (np.abs(x * np.cos(angle) + y * np.sin(angle)) <= (length - 1) / 2)).astype(np.float32)
+        return cv2.filter2D(img, -1, kernel / kernel.sum(), borderType=cv2.BORDER_REPLICATE)
+
+    def __call__(self, data):
+        img, boxes = data
+        matrix = self.matrix(*img.shape[:2])
+        img = cv2.warpAffine(img, matrix[:2], (self.img_size, self.img_size), flags=cv2.INTER_LINEAR,
+                             borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+        boxes = self.transform_boxes(np.asarray(boxes, dtype=np.float64), matrix)
+        return self.photometric(img), boxes
@@ -3,6 +3,8 @@ import random
 import os
 import json
 import sys
+import hashlib
+import inspect
 import numpy as np
 from PIL import Image
 from PIL import ImageFile
@@ -10,17 +12,18 @@ ImageFile.LOAD_TRUNCATED_IMAGES = True
 import torch
 import torch.nn.functional as F
 from collections import defaultdict
-from utils.utils import load_ms, write_ms
+from utils.utils import load_ms, write_ms, letterbox_geometry
 from utils.mean_std import calculate_ms
 import glob
 import warnings
 import matplotlib.pyplot as plt
 
 from utils.transforms import *
-from utils.augmentations import DefaultAug
-from torch.utils.data import Dataset
+from utils.augmentations import DefaultAug, WarpAug
+from torch.utils.data import Dataset, BatchSampler, Sampler
 import torchvision.transforms as transforms
 from utils.fda import FDA_source_to_target_np
+from utils.image_store import ImageStore
 
 
 def pad_to_square(img, pad_value):
@@ -41,6 +44,255 @@ def resize(image, size):
     return image
 
 
+def load_letterbox(img_path, img_size):
+    """
+    Decodes an image straight into an (img_size, img_size, 3) uint8 letterbox: JPEGs are decoded at
+    a reduced DCT scale (PIL draft) that is still at least the target size, the image is resized
+    keeping its aspect ratio and then padded with zeros, centered like PadSquare
+    img_size: size of the square, or (h, w) of a rectangular letterbox (see AspectRatioBatchSampler)
+    Returns the letterbox, the original (h, w), the (x, y) scale and the (left, top) padding
+    """
+    height, width = img_size if isinstance(img_size, (tuple, list)) else (img_size, img_size)
+    img = Image.open(img_path)
+    orig_w, orig_h = img.size
+    (new_w, new_h), (left, top) = letterbox_geometry((orig_h, orig_w), (height, width))
+    if img.format == "JPEG":
+        img.draft("RGB", (new_w, new_h))
+    img = img.convert("RGB")
+    if img.size != (new_w, new_h):
+        img = img.resize((new_w, new_h), Image.BILINEAR)
+
+    letterbox = np.zeros((height, width, 3), dtype=np.uint8)
+    letterbox[top:top + new_h, left:left + new_w] = np.asarray(img)
+    return letterbox, (orig_h, orig_w), (new_w / orig_w, new_h / orig_h), (left, top)
+
+
+def letterbox_boxes(boxes, scale, pad):
+    """ Maps (label, x, y, w, h, angle) boxes in original pixels into the letterbox of load_letterbox """
+    boxes = boxes.copy()
+    boxes[:, [1, 3]] *= scale[0]
+    boxes[:, [2, 4]] *= scale[1]
+    boxes[:, 1] += pad[0]
+    boxes[:, 2] += pad[1]
+    return boxes
+
+
+def collate_images(imgs, img_size):
+    """
+    Resizes (c, h, w) images to img_size and writes them into one preallocated (n, c, img_size, img_size)
+    batch, img_size can be the (h, w) of rectangular batches. In a dataloader worker the batch is allocated in shared memory, like default_collate does, so it
+    is not copied again on its way to the main process; in the main process it is pinned when CUDA is
+    available so the copy to the device can be asynchronous.
+    Images already at img_size (image store, fast_letterbox, warp_aug) are stacked straight into the batch.
+    Other images are resized one by one into their slot: one interpolate call for the whole batch would
+    first have to stack the full resolution images, which costs more than it saves.
+    """
+    n, c = len(imgs), imgs[0].size(0)
+    shape = tuple(img_size) if isinstance(img_size, (tuple, list)) else (img_size, img_size)
+    in_worker = torch.utils.data.get_worker_info() is not None
+    batch = torch.empty((n, c, *shape), dtype=imgs[0].dtype, pin_memory=not in_worker and torch.cuda.is_available())
+    if in_worker:
+        batch.share_memory_()
+
+    if all(img.shape[-2:] == shape for img in imgs):
+        torch.stack(imgs, out=batch)
+    else:
+        for i, img in enumerate(imgs):
+            batch[i] = img if img.shape[-2:] == shape else resize(img, shape)
+    return batch
+
+
+class BatchPrefetcher(object):
+    """
+    Iterates a dataloader of uint8 images (uint8_output=True) and returns the batches with the images on
+    the device as float, scaled to [0, 1] and normalized with mean/std (None: only scaled) in one fused op.
+    The other entries of the batch (paths, targets) are returned unchanged. On CUDA the images of the
+    next batch are copied and normalized on a side stream while the current batch is used.
+    """
+
+    def __init__(self, loader, device, mean=None, std=None):
+        self.loader = loader
+        self.device = torch.device(device)
+        mean = torch.tensor(mean if mean is not None else [0.0, 0.0, 0.0]).view(1, -1, 1, 1)
+        std = torch.tensor(std if std is not None else [1.0, 1.0, 1.0]).view(1, -1, 1, 1)
+        # (x / 255 - mean) / std = x * scale + shift
+        self.scale = (1 / (255 * std)).to(self.device)
+        self.shift = (-mean / std).to(self.device)
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def normalize(self, imgs):
+        imgs = imgs.to(self.device, non_blocking=True)
+        if imgs.dtype == torch.uint8:
+            imgs = torch.addcmul(self.shift, imgs, self.scale)
+        return imgs
+
+    def __iter__(self):
+        if self.stream is None:
+            for paths, imgs, *rest in self.loader:
+                yield (paths, self.normalize(imgs), *rest)
+            return
+
+        pending = None
+        for paths, imgs, *rest in self.loader:
+            with torch.cuda.stream(self.stream):
+                imgs = self.normalize(imgs)
+            if pending is not None:
+                yield pending
+            torch.cuda.current_stream(self.device).wait_stream(self.stream)
+            imgs.record_stream(torch.cuda.current_stream(self.device))
+            pending = (paths, imgs, *rest)
+        if pending is not None:
+            yield pending
+
+
+class MultiscaleBatchSampler(BatchSampler):
+    """
+    Batch sampler for multiscale training: yields batches of (index, img_size), ListDataset returns the
+    size with the sample and collate_fn resizes the batch to it. Every 'interval' consecutive batches share
+    one size of min_size..max_size (multiples of 32), drawn from a generator seeded with the seed and the
+    global batch number, so the schedule does not depend on the number of workers and is the same when
+    a run is repeated. Call set_epoch at the start of each epoch, the global batch number continues over
+    epochs (and over a resume).
+    """
+
+    def __init__(self, sampler, batch_size, drop_last, min_size, max_size, interval=10, seed=0):
+        super(MultiscaleBatchSampler, self).__init__(sampler, batch_size, drop_last)
+        self.sizes = list(range(min_size, max_size + 1, 32))
+        self.interval = interval
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def img_size(self, batch_number):
+        """ Input size of the global batch number """
+        return random.Random(self.seed * 2 ** 32 + batch_number // self.interval).choice(self.sizes)
+
+    def __iter__(self):
+        first = self.epoch * len(self)
+        for batch_i, batch in enumerate(super(MultiscaleBatchSampler, self).__iter__()):
+            img_size = self.img_size(first + batch_i)
+            yield [(index, img_size) for index in batch]
+
+
+class AspectRatioBatchSampler(Sampler):
+    """
+    Batch sampler for rectangular inference: sorts the images by aspect ratio (read from the image
+    headers) and yields batches of (index, (h, w)) of neighbouring images. (h, w) is the smallest
+    rectangle with multiples of 'stride' that holds every image of the batch letterboxed to img_size
+    on its long side, so wide frames are not padded to a square. The order is fixed, not shuffled.
+    """
+
+    def __init__(self, img_files, batch_size, img_size, stride=32):
+        self.batch_size = batch_size
+        shapes = []
+        for path in img_files:
+            with Image.open(path.rstrip()) as img:
+                shapes.append(img.size[::-1])
+        ratios = np.array([h / w for h, w in shapes])
+        order = np.argsort(ratios, kind="stable")
+        self.batches = []
+        for start in range(0, len(order), batch_size):
+            indices = order[start:start + batch_size]
+            low, high = ratios[indices].min(), ratios[indices].max()
+            # (h, w) relative to img_size: wide batches keep the width, tall ones the height
+            if high < 1:
+                shape = (high, 1)
+            elif low > 1:
+                shape = (1, 1 / low)
+            else:
+                shape = (1, 1)
+            shape = tuple(int(np.ceil(side * img_size / stride) * stride) for side in shape)
+            self.batches.append([(int(index), shape) for index in indices])
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+class PassRandomSampler(Sampler):
+    """
+    Random permutation of the dataset drawn from (seed, pass), starting at position 'start' of it,
+    so a pass can be repeated or resumed in the middle (see InfiniteBatchStream)
+    """
+
+    def __init__(self, data_source, seed=0):
+        self.data_source = data_source
+        self.seed = seed
+        self.pass_index = 0
+        self.start = 0
+
+    def set_pass(self, pass_index, start=0):
+        self.pass_index = pass_index
+        self.start = start
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed * 2 ** 32 + self.pass_index)
+        return iter(torch.randperm(len(self.data_source), generator=generator)[self.start:].tolist())
+
+    def __len__(self):
+        return max(len(self.data_source) - self.start, 0)
+
+
+class InfiniteBatchStream(object):
+    """
+    Endless batches of a dataset for next(), e.g. the target domain images of the UDA methods.
+    Unlike itertools.cycle over a DataLoader, which keeps every batch of the first pass in memory
+    and then replays them in the same order, every pass is a new permutation and no batch is kept.
+    The workers are persistent over the passes. state_dict holds the pass and the number of batches
+    taken from it, after load_state_dict the stream continues with the next batch of that pass.
+    loader_kwargs: further arguments of the DataLoader (pin_memory, collate_fn, ...)
+    """
+
+    def __init__(self, dataset, batch_size, num_workers=0, seed=0, **loader_kwargs):
+        if len(dataset) == 0:
+            raise ValueError("InfiniteBatchStream needs a non-empty dataset")
+        self.batch_size = batch_size
+        self.sampler = PassRandomSampler(dataset, seed=seed)
+        if num_workers > 0 and "persistent_workers" in inspect.signature(torch.utils.data.DataLoader.__init__).parameters:
+            loader_kwargs["persistent_workers"] = True
+        self.loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, sampler=self.sampler, num_workers=num_workers,
+                                                  **loader_kwargs)
+        self.pass_index = 0
+        self.position = 0
+        self.iterator = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while True:
+            if self.iterator is None:
+                # Batches already taken from this pass are skipped by the sampler, not loaded
+                self.sampler.set_pass(self.pass_index, start=self.position * self.batch_size)
+                self.iterator = iter(self.loader)
+            try:
+                batch = next(self.iterator)
+            except StopIteration:
+                self.pass_index += 1
+                self.position = 0
+                self.iterator = None
+                continue
+            self.position += 1
+            return batch
+
+    def state_dict(self):
+        return {"seed": self.sampler.seed, "pass": self.pass_index, "position": self.position}
+
+    def load_state_dict(self, state_dict):
+        self.sampler.seed = state_dict["seed"]
+        self.pass_index = state_dict["pass"]
+        self.position = state_dict["position"]
+        self.iterator = None
+
+
 def random_resize(images, min_size=288, max_size=448):
     new_size = random.sample(list(range(min_size, max_size + 1, 32)), 1)[0]
     images = F.interpolate(images, size=new_size, mode="nearest")
@@ -48,11 +300,17 @@ def random_resize(images, min_size=288, max_size=448):
 
 
 class ImageFolder(Dataset):
-    def __init__(self, folder_path, train_data=None, img_size=416, augment=False ):
+    def __init__(self, folder_path, train_data=None, img_size=416, augment=False, fast_letterbox=False, uint8_output=False, normalize=True ):
         self.files = sorted(glob.glob("%s/*.*" % folder_path))
         self.img_size = img_size
         self.pixel_norm = False
         self.augment = augment
+        # Decode at reduced scale and resize before padding (load_letterbox), without augmentation
+        self.fast_letterbox = fast_letterbox
+        # Images are returned as uint8 (c, h, w), conversion and normalization run on the consumer side (BatchPrefetcher)
+        self.uint8_output = uint8_output
+        # With normalize=False mean_t/std_t are loaded but not applied (e.g. folded into the model)
+        self.normalize = normalize
 
         if train_data == 'theodore': 
             self.pixel_norm = True
@@ -82,7 +340,20 @@ class ImageFolder(Dataset):
 
 
     def __getitem__(self, index):
+        # (index, (h, w)) from AspectRatioBatchSampler: rectangular letterbox of the batch
+        rect_shape = None
+        if isinstance(index, tuple):
+            index, rect_shape = index
         img_path = self.files[index % len(self.files)]
+        if rect_shape is not None or (self.fast_letterbox and not self.augment):
+            letterbox = load_letterbox(img_path, rect_shape if rect_shape is not None else self.img_size)[0]
+            if self.uint8_output:
+                return img_path, uint8_tensor(letterbox)
+            img = transforms.ToTensor()(letterbox)
+            if self.pixel_norm == True and self.normalize:
+                img = transforms.Normalize(self.mean_t, self.std_t)(img)
+            return img_path, img
+
         # Extract image as PyTorch tensor
         img = np.array(Image.open(img_path).convert('RGB'), dtype='uint8')
         boxes = np.zeros((1, 6))
@@ -93,18 +364,18 @@ class ImageFolder(Dataset):
                 DefaultAug(),
                 PadSquare(),
                 RelativeLabels(),
-                ToTensor(),
+                ToTensor(uint8=self.uint8_output),
                 ])
         else:
             tran = transforms.Compose([
                 PadSquare(),
                 RelativeLabels(),
-                ToTensor(),
+                ToTensor(uint8=self.uint8_output),
                 ])
         
         img, _ = tran((img,boxes))
 
-        if self.pixel_norm == True:
+        if self.pixel_norm == True and self.normalize and not self.uint8_output:
             img = transforms.Normalize(self.mean_t, self.std_t)(img)
 
         # Resize
@@ -116,12 +387,140 @@ class ImageFolder(Dataset):
         return len(self.files)
 
 
+def stratified_subset(img_files, label_boxes, label_offsets, size, seed=0):
+    """
+    Indices of a fixed, seeded subset of 'size' images, stratified by domain (folder of the image)
+    and class. Every image counts for the rarest class it contains (-1 without labels), the strata
+    are sampled in proportion to their size with at least one image each while 'size' allows.
+    label_boxes, label_offsets: boxes of the images as returned by load_label_index
+    """
+    image_classes = []
+    class_counts = defaultdict(int)
+    for i in range(len(img_files)):
+        classes = set(np.asarray(label_boxes[label_offsets[i]:label_offsets[i + 1], 0]).astype(int).tolist())
+        for c in classes:
+            class_counts[c] += 1
+        image_classes.append(classes)
+
+    strata = defaultdict(list)
+    for i, (path, classes) in enumerate(zip(img_files, image_classes)):
+        primary = min(classes, key=lambda c: (class_counts[c], c)) if classes else -1
+        strata[(os.path.dirname(path.rstrip()), primary)].append(i)
+    keys = sorted(strata)
+    stratum_sizes = np.array([len(strata[key]) for key in keys])
+
+    # Proportional allocation, the remainder goes to the largest fractional parts
+    size = min(size, len(img_files))
+    quota = stratum_sizes * size / stratum_sizes.sum()
+    allocation = np.minimum(np.maximum(np.floor(quota).astype(int), 1 if size >= len(keys) else 0), stratum_sizes)
+    # One extra image per stratum in remainder order, again while full strata leave some over
+    order = np.argsort(np.floor(quota) - quota, kind="stable")
+    while allocation.sum() < size:
+        for k in order:
+            if allocation.sum() >= size:
+                break
+            if allocation[k] < stratum_sizes[k]:
+                allocation[k] += 1
+    while allocation.sum() > size:
+        allocation[np.argmax(allocation)] -= 1
+
+    rng = np.random.RandomState(seed)
+    indices = [rng.choice(strata[key], n, replace=False) for key, n in zip(keys, allocation)]
+    return sorted(int(i) for i in np.concatenate(indices))
+
+
+def load_stratified_subset(list_path, img_files, label_files, size, seed=0):
+    """
+    stratified_subset cached next to the list file, rebuilt when the list changes or a label file
+    was added, removed or modified (mtime). The labels are read from load_label_index.
+    """
+    label_files = [path.rstrip() for path in label_files]
+    mtimes = [os.stat(path).st_mtime_ns if os.path.exists(path) else -1 for path in label_files]
+    with open(list_path, "rb") as file:
+        key = hashlib.sha1(file.read())
+    key.update(" ".join(map(str, mtimes)).encode())
+    key = key.hexdigest()
+    cache_path = os.path.splitext(list_path)[0] + f"_subset{size}_seed{seed}.json"
+    try:
+        with open(cache_path, "r") as file:
+            cache = json.load(file)
+        if cache.get("key") == key:
+            return cache["indices"]
+    except (OSError, ValueError):
+        pass
+
+    label_boxes, label_offsets, _ = load_label_index(list_path, label_files)
+    indices = stratified_subset(img_files, label_boxes, label_offsets, size, seed=seed)
+    try:
+        with open(cache_path, "w") as file:
+            json.dump({"key": key, "indices": indices}, file)
+    except OSError as e:
+        print(f"Stratified subset is not cached: {e}")
+    return indices
+
+
+def load_label_index(list_path, label_files):
+    """
+    All boxes (label, x, y, w, h, angle) of 'label_files' in one float32 array with the offsets of
+    every image, parsed once and saved as .npy in <list>_labelcache next to the list file. The
+    index is rebuilt when a label file was added, removed or modified (mtime).
+    Returns boxes, offsets and whether the label file of each image exists
+    """
+    label_files = [path.rstrip() for path in label_files]
+    mtimes = np.array([os.stat(path).st_mtime_ns if os.path.exists(path) else -1 for path in label_files], dtype=np.int64)
+    # One index per list and label variant (labels/labelsbbox, person/all_class, subsets)
+    key = hashlib.sha1("\n".join(label_files).encode()).hexdigest()[:16]
+    cache_prefix = os.path.join(os.path.splitext(list_path)[0] + "_labelcache", key)
+
+    try:
+        if np.array_equal(np.load(cache_prefix + "_mtimes.npy"), mtimes):
+            offsets = np.load(cache_prefix + "_offsets.npy")
+            boxes = np.load(cache_prefix + "_boxes.npy", mmap_mode="r" if offsets[-1] > 0 else None)
+            return boxes, offsets, mtimes >= 0
+    except (OSError, ValueError):
+        pass
+
+    boxes = []
+    offsets = [0]
+    for path, mtime in zip(label_files, mtimes):
+        image_boxes = np.zeros((0, 6))
+        if mtime >= 0:
+            # Ignore warning if file is empty
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                image_boxes = np.loadtxt(path).reshape(-1, 6)
+        boxes.append(image_boxes.astype(np.float32))
+        offsets.append(offsets[-1] + len(image_boxes))
+    boxes = np.concatenate(boxes) if boxes else np.zeros((0, 6), dtype=np.float32)
+    offsets = np.array(offsets, dtype=np.int64)
+
+    try:
+        os.makedirs(os.path.dirname(cache_prefix), exist_ok=True)
+        np.save(cache_prefix + "_boxes.npy", boxes)
+        np.save(cache_prefix + "_offsets.npy", offsets)
+        # mtimes are written last, they mark the index as complete
+        np.save(cache_prefix + "_mtimes.npy", mtimes)
+    except OSError as e:
+        print(f"Label index is not cached: {e}")
+    return boxes, offsets, mtimes >= 0
+
+
 class ListDataset(Dataset):
     def __init__(self, list_path, use_angle, class_num, img_size=416, augment=True, multiscale=True, normalized_labels=True,
-                     pixel_norm=False, train_data=None, uda_method=None, beta=0.01, circular=False ):
+                     pixel_norm=False, train_data=None, uda_method=None, beta=0.01, circular=False, shard=None, indices=None,
+                     image_store=None, label_cache=True, normalize=True, warp_aug=False, fast_letterbox=False, uint8_output=False ):
         with open(list_path, "r") as file:
             self.img_files = file.readlines()
 
+        if indices is not None:
+            # Fixed subset of the list (e.g. stratified_subset)
+            self.img_files = [self.img_files[i] for i in indices]
+
+        if shard is not None:
+            # shard = (index, count): use every count-th image starting at index
+            shard_index, shard_count = shard
+            self.img_files = self.img_files[shard_index::shard_count]
+
         '''if uda_method == 'fda':
             self.trg_files = glob.glob('/localdata/saurabh/yolov3/data/cepdof/all_images/*')'''
 
@@ -156,9 +555,24 @@ class ListDataset(Dataset):
         self.max_size = self.img_size + 3 * 32
         self.batch_count = 0
         self.pixel_norm = pixel_norm
+        # With normalize=False mean_t/std_t are loaded but applied by the consumer (e.g. BatchAug)
+        self.normalize = normalize
+        # Augmentation, pad and resize in one warp (WarpAug) instead of DefaultAug + PadSquare
+        self.warp_aug = warp_aug
+        self.use_angle = use_angle
+        # Decode at reduced scale and resize before padding (load_letterbox), without augmentation
+        self.fast_letterbox = fast_letterbox
+        # Images are returned as uint8 (c, h, w), conversion and normalization run on the consumer side (BatchPrefetcher)
+        self.uint8_output = uint8_output
         self.uda_method = uda_method
         self.beta = beta
         self.circular = circular
+        # Pre-decoded letterboxed images (see pack_images.py), images missing in the store are decoded
+        self.image_store = ImageStore(image_store, img_size) if image_store is not None else None
+        # Boxes of all label files parsed once (see load_label_index)
+        self.label_cache = label_cache
+        if label_cache:
+            self.label_boxes, self.label_offsets, self.label_exists = load_label_index(list_path, self.label_files)
 
         if use_angle == True:
             self.augment = False
@@ -235,13 +649,35 @@ class ListDataset(Dataset):
                 self.mean_t, self.std_t = [0.485, 0.456, 0.406], [0.229, 0.224, 0.225]
 
     def __getitem__(self, index):
+        # (index, img_size) from MultiscaleBatchSampler or (index, (h, w)) from AspectRatioBatchSampler,
+        # the size is passed on to collate_fn
+        if isinstance(index, tuple):
+            index, img_size = index
+            rect_shape = img_size if isinstance(img_size, tuple) else None
+            return (*self.load_sample(index, rect_shape=rect_shape), img_size)
+        return self.load_sample(index)
+
+    def load_sample(self, index, rect_shape=None):
+        """ Image and targets of one sample, rect_shape: (h, w) of a rectangular letterbox instead of the square """
         #---------
         #  Image
         # ---------
 
         img_path = self.img_files[index % len(self.img_files)].rstrip()
         #print(img_path)
-        img = np.array(Image.open(img_path).convert('RGB'), dtype=np.uint8) #/255.0
+        from_store = rect_shape is None and self.image_store is not None and img_path in self.image_store
+        letterbox = None
+        if from_store:
+            # Already padded to square and resized, labels are mapped with letterbox_boxes
+            img = self.image_store.image(img_path)
+            img_shape = self.image_store.original_shape(img_path)
+        elif rect_shape is not None:
+            img, img_shape, *letterbox = load_letterbox(img_path, rect_shape)
+        elif self.fast_letterbox and not self.augment:
+            img, img_shape, *letterbox = load_letterbox(img_path, self.img_size)
+        else:
+            img = np.array(Image.open(img_path).convert('RGB'), dtype=np.uint8) #/255.0
+            img_shape = img.shape[:2]
         # if self.augment == True:
         #     img = np.array(Image.open(img_path).convert('RGB'), dtype=np.uint8) #/255.0
         # else:
@@ -275,33 +711,60 @@ class ListDataset(Dataset):
         #  Label
         # ---------
 
-        label_path = self.label_files[index % len(self.img_files)].rstrip()
+        label_index = index % len(self.img_files)
+        label_path = self.label_files[label_index].rstrip()
 
         targets = None
-        if os.path.exists(label_path):
-            # Ignore warning if file is empty
-            with warnings.catch_warnings():
-                warnings.simplefilter("ignore")
-                boxes = np.loadtxt(label_path).reshape(-1, 6)
+        if self.label_cache:
+            label_exists = self.label_exists[label_index]
+        else:
+            label_exists = os.path.exists(label_path)
+        if label_exists:
+            if self.label_cache:
+                boxes = np.array(self.label_boxes[self.label_offsets[label_index]:self.label_offsets[label_index + 1]], dtype=np.float64)
+            else:
+                # Ignore warning if file is empty
+                with warnings.catch_warnings():
+                    warnings.simplefilter("ignore")
+                    boxes = np.loadtxt(label_path).reshape(-1, 6)
 
             if self.normalized_labels == True: 
-                w, h, _ = img.shape 
+                w, h = img_shape
                 boxes[:,[1,3]] *= h
                 boxes[:,[2,4]] *= w
 
-            if self.augment == True:
+            if from_store:
+                boxes = self.image_store.letterbox_boxes(img_path, boxes)
+            elif letterbox is not None:
+                boxes = letterbox_boxes(boxes, *letterbox)
+
+            if rect_shape is not None:
+                # Inference on rectangular batches, already letterboxed, the boxes are converted like
+                # on the square path so the mAP of both is comparable
+                tran = transforms.Compose([
+                KeepLetterbox(),
+                RelativeLabels(),
+                ToTensor(uint8=self.uint8_output),
+                ])
+            elif self.augment == True and self.warp_aug:
+                tran = transforms.Compose([
+                WarpAug(self.img_size, use_angle=self.use_angle),
+                RelativeLabels(),
+                ToTensor(uint8=self.uint8_output),
+                ])
+            elif self.augment == True:
                 tran = transforms.Compose([
                 DefaultAug(),
                 PadSquare(),
                 RelativeLabels(),
-                ToTensor(),
+                ToTensor(uint8=self.uint8_output),
                 ])
             else:
                 tran = transforms.Compose([
                 # jitter(),
                 PadSquare(),
                 RelativeLabels(),
-                ToTensor(),
+                ToTensor(uint8=self.uint8_output),
                 # basic_aug()
                 ])
 
@@ -310,18 +773,22 @@ class ListDataset(Dataset):
         else:
             img = np.array(img, dtype=np.uint8)
 
+        if self.uint8_output:
+            if not torch.is_tensor(img):
+                img = uint8_tensor(img)
+            return img_path, img, targets
 
         if img.shape[2] == 3:
             img = transforms.ToTensor()(img)
 
-        if self.pixel_norm == True:
+        if self.pixel_norm == True and self.normalize:
             img = transforms.Normalize(self.mean_t, self.std_t)(img) 
 
         return img_path, img, targets
 
     
     def collate_fn(self, batch):
-        paths, imgs, targets = list(zip(*batch))
+        paths, imgs, targets, *img_sizes = list(zip(*batch))
         # Add sample index to targets
         for i, boxes in enumerate(targets):
             if boxes is None:
@@ -336,11 +803,16 @@ class ListDataset(Dataset):
         except RuntimeError as e_inst:
             targets = None # No boxes for an image
             
-        # Selects new image size every tenth batch
-        if self.multiscale and self.batch_count % 10 == 0:
-            self.img_size = random.choice(range(self.min_size, self.max_size + 1, 32))
-        # Resize images to input shape
-        imgs = torch.stack([resize(img, self.img_size) for img in imgs])
+        if img_sizes:
+            # Size of the batch from the schedule of MultiscaleBatchSampler
+            img_size = img_sizes[0][0]
+        else:
+            # Selects new image size every tenth batch (per worker, use MultiscaleBatchSampler for one schedule)
+            if self.multiscale and self.batch_count % 10 == 0:
+                self.img_size = random.choice(range(self.min_size, self.max_size + 1, 32))
+            img_size = self.img_size
+        # Resize images to input shape, straight into the batch buffer
+        imgs = collate_images(imgs, img_size)
         self.batch_count += 1
         return paths, imgs, targets
 
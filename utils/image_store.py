@@ -0,0 +1,105 @@
+import os
+import json
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+
+def letterbox(img, size):
+    """
+    Pads an (h, w, 3) uint8 image to a square with zeros, centered like PadSquare, and resizes it
+    to (size, size) with nearest interpolation like ListDataset.collate_fn
+    Returns the letterboxed image, the padding (top, left) in original pixels and the scale
+    """
+    h, w, _ = img.shape
+    side = max(h, w)
+    top, left = (side - h) // 2, (side - w) // 2
+    padded = np.zeros((side, side, 3), dtype=np.uint8)
+    padded[top:top + h, left:left + w] = img
+    if side != size:
+        padded = F.interpolate(torch.from_numpy(padded).permute(2, 0, 1).unsqueeze(0).float(), size=size, mode="nearest")
+        padded = padded.squeeze(0).permute(1, 2, 0).byte().numpy()
+    return np.ascontiguousarray(padded), (top, left), size / side
+
+
+def _decode_letterbox(args):
+    """ Worker of pack_image_store: decodes one image and letterboxes it to every size """
+    path, sizes = args
+    img = np.array(Image.open(path).convert('RGB'), dtype=np.uint8)
+    return img.shape[:2], [letterbox(img, size)[0] for size in sizes]
+
+
+def pack_image_store(list_path, store_path, sizes=(416,), n_cpu=8):
+    """
+    Decodes every image of the list once and writes the letterboxed uint8 images of each size
+    to 'store_path'/images_<size>.u8, one record after the other, with the record offsets in
+    offsets_<size>.npy and the image files with their original shapes in meta.json
+    """
+    from multiprocessing import Pool
+    import tqdm
+
+    with open(list_path, "r") as file:
+        img_files = [path.rstrip() for path in file.readlines()]
+    os.makedirs(store_path, exist_ok=True)
+
+    files = {size: open(os.path.join(store_path, f"images_{size}.u8"), "wb") for size in sizes}
+    offsets = {size: [0] for size in sizes}
+    shapes = []
+    with Pool(n_cpu) as pool:
+        for shape, images in tqdm.tqdm(pool.imap(_decode_letterbox, [(path, sizes) for path in img_files], chunksize=16),
+                                       total=len(img_files), desc="Packing images"):
+            shapes.append(shape)
+            for size, img in zip(sizes, images):
+                files[size].write(img.tobytes())
+                offsets[size].append(offsets[size][-1] + img.nbytes)
+
+    for size in sizes:
+        files[size].close()
+        np.save(os.path.join(store_path, f"offsets_{size}.npy"), np.array(offsets[size], dtype=np.int64))
+    # meta.json is written last, an interrupted packing leaves no valid store
+    with open(os.path.join(store_path, "meta.json"), "w") as file:
+        json.dump({"img_files": img_files, "shapes": shapes, "sizes": list(sizes)}, file)
+
+
+class ImageStore(object):
+    """
+    Read side of pack_image_store. Images are views of a memory-mapped file, the map is opened on
+    first access so every dataloader worker gets its own.
+    img_size: size of the records to read, the largest packed size if it was not packed
+    """
+
+    def __init__(self, store_path, img_size):
+        with open(os.path.join(store_path, "meta.json"), "r") as file:
+            meta = json.load(file)
+        self.size = img_size if img_size in meta["sizes"] else max(meta["sizes"])
+        self.data_path = os.path.join(store_path, f"images_{self.size}.u8")
+        self.offsets = np.load(os.path.join(store_path, f"offsets_{self.size}.npy"))
+        self.shapes = np.array(meta["shapes"], dtype=np.int64).reshape(-1, 2)
+        self.index = {path: i for i, path in enumerate(meta["img_files"])}
+        self.data = None
+
+    def __contains__(self, img_path):
+        return img_path in self.index
+
+    def image(self, img_path):
+        """ (size, size, 3) uint8 view of the letterboxed image """
+        if self.data is None:
+            self.data = np.memmap(self.data_path, dtype=np.uint8, mode="r")
+        i = self.index[img_path]
+        return self.data[self.offsets[i]:self.offsets[i + 1]].reshape(self.size, self.size, 3)
+
+    def original_shape(self, img_path):
+        """ (h, w) of the image before letterboxing """
+        return tuple(self.shapes[self.index[img_path]])
+
+    def letterbox_boxes(self, img_path, boxes):
+        """ Maps (label, x, y, w, h, angle) boxes in original pixels to pixels of the stored image """
+        h, w = self.original_shape(img_path)
+        side = max(h, w)
+        scale = self.size / side
+        boxes = boxes.copy()
+        boxes[:, 1] = (boxes[:, 1] + (side - w) // 2) * scale
+        boxes[:, 2] = (boxes[:, 2] + (side - h) // 2) * scale
+        boxes[:, 3:5] *= scale
+        return boxes
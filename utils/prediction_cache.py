@@ -0,0 +1,140 @@
+import os
+import json
+import hashlib
+import numpy as np
+import torch
+
+
+def prediction_cache_key(model, img_files, label_files, img_size, use_angle, class_num, train_data, conf_floor, fast_letterbox=False,
+                         rect=False):
+    """
+    Key of the cached predictions: hash of the weights, the model definition, the image size,
+    the dataset manifest (image and label files with size and modification time) and every
+    option that changes the raw head outputs
+    """
+    key = hashlib.sha1()
+    # Checkpoint
+    for name, value in model.state_dict().items():
+        key.update(name.encode())
+        key.update(value.detach().cpu().numpy().tobytes())
+    # Model definition
+    key.update(repr(model.module_defs).encode())
+    key.update(repr(model.hyperparams).encode())
+    # Dataset manifest
+    for path in list(img_files) + list(label_files):
+        path = path.rstrip()
+        stat = os.stat(path) if os.path.exists(path) else None
+        key.update(f"{path} {stat.st_size if stat else -1} {stat.st_mtime_ns if stat else -1}\n".encode())
+    key.update(repr((img_size, use_angle, class_num, train_data, conf_floor)).encode())
+    # The reduced-scale letterbox resamples the images differently
+    if fast_letterbox:
+        key.update(b"fast_letterbox")
+    # Rectangular batches (AspectRatioBatchSampler) change the inputs and the image order
+    if rect:
+        key.update(b"rect")
+    return key.hexdigest()
+
+
+class PredictionCache(object):
+    """
+    On-disk cache of the raw (pre-NMS) head outputs of an evaluation run, so that the mAP for
+    other NMS and matching thresholds can be computed without running the model again.
+    Only candidates with an object confidence of at least 'conf_floor' are kept, which makes
+    re-scoring exact for every conf_thres >= conf_floor.
+    Rows are appended to flat float32 files while the evaluation runs, memory does not grow
+    with the size of the dataset:
+        predictions.f32: (image_index, x, y, w, h, angle, object_conf, class_scores...)
+        targets.f32:     (image_index, label, x1, y1, x2, y2, angle) in input pixels
+        meta.json:       shapes, floor and the loss/accuracy sums of the run
+    """
+
+    def __init__(self, cache_dir, key, conf_floor=0.01):
+        self.path = os.path.join(cache_dir, key)
+        self.conf_floor = conf_floor
+        self.num_images = 0
+
+    def exists(self):
+        return os.path.isfile(os.path.join(self.path, "meta.json"))
+
+    def open(self):
+        """ Starts writing a new cache """
+        os.makedirs(self.path, exist_ok=True)
+        self.num_images = 0
+        self.num_predictions = 0
+        self.num_targets = 0
+        self.prediction_width = None
+        self.prediction_file = open(os.path.join(self.path, "predictions.f32"), "wb")
+        self.target_file = open(os.path.join(self.path, "targets.f32"), "wb")
+
+    def append(self, outputs, targets):
+        """
+        outputs: raw head outputs (batch_size, N, 6 + num_classes) with (x, y, w, h) boxes
+        targets: (sample_index, label, x1, y1, x2, y2, angle) of the batch
+        """
+        outputs = outputs.detach().cpu()
+        self.prediction_width = outputs.size(2) + 1
+        sample_index, box_index = torch.nonzero(outputs[..., 5] >= self.conf_floor, as_tuple=True)
+        rows = torch.cat((sample_index.unsqueeze(1).float() + self.num_images, outputs[sample_index, box_index]), 1)
+        rows.numpy().astype(np.float32).tofile(self.prediction_file)
+        self.num_predictions += rows.size(0)
+
+        targets = targets.detach().cpu().clone()
+        targets[:, 0] += self.num_images
+        targets.numpy().astype(np.float32).tofile(self.target_file)
+        self.num_targets += targets.size(0)
+
+        self.num_images += outputs.size(0)
+
+    def close(self, **run_info):
+        """ Finishes the cache, 'run_info' (e.g. loss sums) is stored next to the shapes """
+        self.prediction_file.close()
+        self.target_file.close()
+        meta = {
+            "num_images": self.num_images,
+            "num_predictions": self.num_predictions,
+            "num_targets": self.num_targets,
+            "prediction_width": self.prediction_width,
+            "conf_floor": self.conf_floor,
+            "run_info": run_info,
+        }
+        # meta.json is written last, an interrupted run leaves no valid cache
+        with open(os.path.join(self.path, "meta.json"), "w") as file:
+            json.dump(meta, file)
+
+    def load(self):
+        """ Memory-maps the cached predictions and targets, returns the run info """
+        with open(os.path.join(self.path, "meta.json"), "r") as file:
+            meta = json.load(file)
+        self.num_images = meta["num_images"]
+        self.conf_floor = meta["conf_floor"]
+        self.predictions = self._memmap("predictions.f32", (meta["num_predictions"], meta["prediction_width"] or 1))
+        self.targets = self._memmap("targets.f32", (meta["num_targets"], 7))
+        self.prediction_offsets = np.searchsorted(self.predictions[:, 0], np.arange(self.num_images + 1))
+        self.target_offsets = np.searchsorted(self.targets[:, 0], np.arange(self.num_images + 1))
+        return meta["run_info"]
+
+    def _memmap(self, name, shape):
+        # An empty file can not be memory-mapped
+        if shape[0] == 0:
+            return np.zeros(shape, dtype=np.float32)
+        return np.memmap(os.path.join(self.path, name), dtype=np.float32, mode="r", shape=shape)
+
+    def batches(self, batch_size):
+        """
+        Yields (outputs, targets) per batch of cached images. Outputs are padded with rows of
+        zero confidence to the largest number of candidates in the batch.
+        """
+        for start in range(0, self.num_images, batch_size):
+            end = min(start + batch_size, self.num_images)
+            counts = np.diff(self.prediction_offsets[start:end + 1])
+            rows = torch.from_numpy(np.array(self.predictions[self.prediction_offsets[start]:self.prediction_offsets[end]]))
+            outputs = torch.zeros((end - start, max(counts.max(), 1), self.predictions.shape[1] - 1))
+            if rows.size(0):
+                sample_index = rows[:, 0].long() - start
+                first_row = torch.from_numpy(self.prediction_offsets[start:end] - self.prediction_offsets[start])
+                box_index = torch.arange(rows.size(0)) - first_row.repeat_interleave(torch.from_numpy(counts))
+                outputs[sample_index, box_index] = rows[:, 1:]
+
+            targets = torch.from_numpy(np.array(self.targets[self.target_offsets[start]:self.target_offsets[end]]))
+            targets[:, 0] -= start
+            yield outputs, targets
@@ -76,6 +76,11 @@ class PadSquare(ImgAug):
                 position="center-center").to_deterministic()
             ])
 
+class KeepLetterbox(ImgAug):
+    """ Box conversion of PadSquare (boxes clipped, angle dropped) for images that are already letterboxed """
+    def __init__(self, ):
+        self.augmentations = iaa.Sequential([])
+
 class RelativeLabels(object):
     def __init__(self, ):
         pass
@@ -87,14 +92,18 @@ class RelativeLabels(object):
         boxes[:,[2,4]] /= w
         return img, boxes
 
+def uint8_tensor(img):
+    """ (h, w, c) uint8 image to a (c, h, w) uint8 tensor, without the float conversion of transforms.ToTensor """
+    return torch.from_numpy(np.ascontiguousarray(np.asarray(img, dtype=np.uint8).transpose(2, 0, 1)))
+
 class ToTensor(object):
-    def __init__(self, ):
-        pass
+    def __init__(self, uint8=False):
+        self.uint8 = uint8
 
     def __call__(self, data):
         img, boxes = data
         # Extract image as PyTorch tensor
-        img = transforms.ToTensor()(img)
+        img = uint8_tensor(img) if self.uint8 else transforms.ToTensor()(img)
 
         bb_targets = torch.zeros((len(boxes), 7))
         bb_targets[:, 1:] = transforms.ToTensor()(boxes)
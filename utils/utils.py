@@ -61,20 +61,32 @@ def weights_init_normal(m):
         torch.nn.init.constant_(m.bias.data, 0.0)
 
 
+def letterbox_geometry(original_shape, current_dim):
+    """
+    Size and padding of an image of original_shape (h, w) letterboxed into current_dim, the size of
+    the square or (h, w) of a rectangular letterbox, resized keeping its aspect ratio and centered
+    Returns the resized (w, h) and the (left, top) padding in pixels
+    """
+    orig_h, orig_w = original_shape
+    current_h, current_w = current_dim if isinstance(current_dim, (tuple, list)) else (current_dim, current_dim)
+    scale = min(current_w / orig_w, current_h / orig_h)
+    new_w, new_h = max(1, round(orig_w * scale)), max(1, round(orig_h * scale))
+    return (new_w, new_h), ((current_w - new_w) // 2, (current_h - new_h) // 2)
+
+
 def rescale_boxes(boxes, current_dim, original_shape):
-    """ Rescales bounding boxes to the original shape """
+    """
+    Rescales bounding boxes to the original shape
+    current_dim: size of the square input, or (h, w) of a rectangular letterbox
+    """
     orig_h, orig_w = original_shape
-    # The amount of padding that was added
-    pad_x = max(orig_h - orig_w, 0) * (current_dim / max(original_shape))
-    pad_y = max(orig_w - orig_h, 0) * (current_dim / max(original_shape))
-    # Image height and width after padding is removed
-    unpad_h = current_dim - pad_y
-    unpad_w = current_dim - pad_x
+    # Image width and height after padding is removed and the padding that was added
+    (unpad_w, unpad_h), (pad_x, pad_y) = letterbox_geometry(original_shape, current_dim)
     # Rescale bounding boxes to dimension of original image
-    boxes[:, 0] = ((boxes[:, 0] - pad_x // 2) / unpad_w) * orig_w
-    boxes[:, 1] = ((boxes[:, 1] - pad_y // 2) / unpad_h) * orig_h
-    boxes[:, 2] = ((boxes[:, 2] - pad_x // 2) / unpad_w) * orig_w
-    boxes[:, 3] = ((boxes[:, 3] - pad_y // 2) / unpad_h) * orig_h
+    boxes[:, 0] = ((boxes[:, 0] - pad_x) / unpad_w) * orig_w
+    boxes[:, 1] = ((boxes[:, 1] - pad_y) / unpad_h) * orig_h
+    boxes[:, 2] = ((boxes[:, 2] - pad_x) / unpad_w) * orig_w
+    boxes[:, 3] = ((boxes[:, 3] - pad_y) / unpad_h) * orig_h
     return boxes
 
 
@@ -159,6 +171,138 @@ def ap_per_class(tp, conf, pred_cls, target_cls):
     return p, r, ap, f1, unique_classes.astype("int32")
 
 
+# IoU thresholds of the COCO mAP@[.5:.95]
+COCO_IOU_THRESHOLDS = np.linspace(0.5, 0.95, 10)
+
+
+class APAccumulator(object):
+    """
+    Streaming version of ap_per_class. Instead of keeping every prediction it counts true and
+    false positives per class and per score bin, plus the number of targets per class, so the
+    memory does not grow with the size of the validation set. Partial accumulators, e.g. of
+    separate processes, can be merged.
+    num_thresholds: number of IoU thresholds the true positives are given for
+    """
+
+    def __init__(self, num_classes, num_bins=1000, num_thresholds=1):
+        self.num_classes = num_classes
+        self.num_bins = num_bins
+        self.num_thresholds = num_thresholds
+        self.tp = np.zeros((num_classes, num_bins, num_thresholds), dtype=np.int64)
+        self.fp = np.zeros((num_classes, num_bins, num_thresholds), dtype=np.int64)
+        self.n_gt = np.zeros(num_classes, dtype=np.int64)
+
+    def update(self, tp, conf, pred_cls, target_cls):
+        """
+        tp:    True positives (array), one column per IoU threshold.
+        conf:  Objectness value from 0-1 (array).
+        pred_cls: Predicted object classes (array).
+        target_cls: True object classes (array).
+        """
+        tp = np.asarray(tp, dtype=np.int64).reshape(-1, self.num_thresholds)
+        conf, pred_cls = np.asarray(conf, dtype=np.float64), np.asarray(pred_cls, dtype=np.int64)
+        bins = np.clip((conf * self.num_bins).astype(np.int64), 0, self.num_bins - 1)
+        np.add.at(self.tp, (pred_cls, bins), tp)
+        np.add.at(self.fp, (pred_cls, bins), 1 - tp)
+        self.n_gt += np.bincount(np.asarray(target_cls, dtype=np.int64), minlength=self.num_classes)
+
+    def merge(self, other):
+        """ Adds the counts of another accumulator """
+        self.tp += other.tp
+        self.fp += other.fp
+        self.n_gt += other.n_gt
+        return self
+
+    def compute(self):
+        """
+        Returns precision, recall, AP, f1 and classes like ap_per_class. With several IoU
+        thresholds precision, recall, AP and f1 have one column per threshold.
+        """
+        # Find classes with targets
+        unique_classes = np.nonzero(self.n_gt)[0]
+
+        # Accumulate FPs and TPs from the highest score bin down
+        tpc = self.tp[:, ::-1].cumsum(1)
+        fpc = self.fp[:, ::-1].cumsum(1)
+        filled = (self.tp + self.fp)[:, ::-1, 0] > 0
+
+        ap = np.zeros((len(unique_classes), self.num_thresholds))
+        p = np.zeros((len(unique_classes), self.num_thresholds))
+        r = np.zeros((len(unique_classes), self.num_thresholds))
+        for ci, c in enumerate(unique_classes):
+            if not filled[c].any():
+                continue
+
+            # Recall
+            recall_curve = tpc[c, filled[c]] / (self.n_gt[c] + 1e-16)
+            r[ci] = recall_curve[-1]
+
+            # Precision
+            precision_curve = tpc[c, filled[c]] / (tpc[c, filled[c]] + fpc[c, filled[c]])
+            p[ci] = precision_curve[-1]
+
+            # AP from recall-precision curve
+            ap[ci] = [compute_ap(recall_curve[:, t], precision_curve[:, t]) for t in range(self.num_thresholds)]
+
+        # Compute F1 score (harmonic mean of precision and recall)
+        f1 = 2 * p * r / (p + r + 1e-16)
+
+        if self.num_thresholds == 1:
+            p, r, ap, f1 = p[:, 0], r[:, 0], ap[:, 0], f1[:, 0]
+        return p, r, ap, f1, unique_classes.astype("int32")
+
+    def pr_curves(self):
+        """
+        Precision-recall curve of every class with targets, from the highest score bin down.
+        Returns a dict class -> (conf, precision, recall), conf is the lower edge of each filled bin
+        and precision and recall have one column per IoU threshold.
+        """
+        tpc = self.tp[:, ::-1].cumsum(1)
+        fpc = self.fp[:, ::-1].cumsum(1)
+        filled = (self.tp + self.fp)[:, ::-1, 0] > 0
+        bin_conf = np.arange(self.num_bins)[::-1] / self.num_bins
+
+        curves = {}
+        for c in np.nonzero(self.n_gt)[0]:
+            recall_curve = tpc[c, filled[c]] / (self.n_gt[c] + 1e-16)
+            precision_curve = tpc[c, filled[c]] / (tpc[c, filled[c]] + fpc[c, filled[c]])
+            curves[int(c)] = (bin_conf[filled[c]], precision_curve, recall_curve)
+        return curves
+
+    def sweep(self, conf_thresholds):
+        """
+        Precision, recall, AP and f1 per class for a list of confidence thresholds from the counts
+        of a single run at the lowest threshold. Keeping the detections with conf >= t cuts the
+        curves at the bin of t, so thresholds on a bin edge (multiples of 1 / num_bins) give the
+        counts of a run at that threshold.
+        Note: NMS itself can differ with conf_thres (candidates between the thresholds may suppress
+        or merge others), the sweep is exact for the matching and approximate for NMS.
+        Returns p, r, ap, f1 of shape (classes, thresholds[, IoU thresholds]) and the classes
+        """
+        conf_thresholds = np.asarray(conf_thresholds, dtype=np.float64)
+        curves = self.pr_curves()
+        unique_classes = np.nonzero(self.n_gt)[0]
+
+        shape = (len(unique_classes), len(conf_thresholds), self.num_thresholds)
+        p, r, ap = np.zeros(shape), np.zeros(shape), np.zeros(shape)
+        for ci, c in enumerate(unique_classes):
+            conf, precision_curve, recall_curve = curves[int(c)]
+            # conf is descending, the points kept for a threshold are a prefix of the curve
+            kept = len(conf) - np.searchsorted(conf[::-1], np.floor(conf_thresholds * self.num_bins) / self.num_bins)
+            for k, n in enumerate(kept):
+                if n == 0:
+                    continue
+                p[ci, k] = precision_curve[n - 1]
+                r[ci, k] = recall_curve[n - 1]
+                ap[ci, k] = [compute_ap(recall_curve[:n, t], precision_curve[:n, t]) for t in range(self.num_thresholds)]
+
+        f1 = 2 * p * r / (p + r + 1e-16)
+
+        if self.num_thresholds == 1:
+            p, r, ap, f1 = p[..., 0], r[..., 0], ap[..., 0], f1[..., 0]
+        return p, r, ap, f1, unique_classes.astype("int32")
+
+
 def compute_ap(recall, precision):
     """ Compute the average precision, given the recall and precision curves.
     Code originally from https://github.com/rbgirshick/py-faster-rcnn.
@@ -175,8 +319,7 @@ def compute_ap(recall, precision):
     mpre = np.concatenate(([0.0], precision, [0.0]))
 
     # compute the precision envelope
-    for i in range(mpre.size - 1, 0, -1):
-        mpre[i - 1] = np.maximum(mpre[i - 1], mpre[i])
+    mpre = np.flip(np.maximum.accumulate(np.flip(mpre)))
 
     # to calculate area under PR curve, look for points
     # where X axis (recall) changes value
@@ -187,58 +330,92 @@ def compute_ap(recall, precision):
     return ap
 
 
-def get_batch_statistics(outputs, targets, iou_threshold, use_angle):
-    """ Compute true positives, predicted scores and predicted labels per sample """
-    batch_metrics = []
-    for sample_i in range(len(outputs)):
-
-        if outputs[sample_i] is None:
-            continue
-
-        output = outputs[sample_i]
-        pred_boxes = output[:, :5]
-        pred_scores = output[:, 5]
-        pred_labels = output[:, -1]
+def detection_target_iou(outputs, targets, use_angle):
+    """
+    IoU matrix of packed detections (sample_index, x1, y1, x2, y2, angle, ..., class_pred) against
+    targets (sample_index, label, x1, y1, x2, y2, angle) of a whole batch.
+    Pairs from different samples or with different labels have an IoU of 0.
+    """
+    if use_angle == 'True':
+        # Only pairs of the same sample and label are compared
+        n_labels = int(max(outputs[:, -1].max() if len(outputs) else 0, targets[:, 1].max() if len(targets) else 0)) + 1
+        pred_group = outputs[:, 0] * n_labels + outputs[:, -1]
+        target_group = targets[:, 0] * n_labels + targets[:, 1]
+        return rotated_iou_matrix(outputs[:, 1:6], targets[:, 2:7], group1=pred_group, group2=target_group)
 
-        true_positives = np.zeros(pred_boxes.shape[0])
+    iou = bbox_iou_matrix(outputs[:, 1:5], targets[:, 2:6])
+    same_sample = outputs[:, 0].unsqueeze(1) == targets[:, 0].unsqueeze(0)
+    label_match = outputs[:, -1].unsqueeze(1) == targets[:, 1].unsqueeze(0)
+    return iou * (same_sample & label_match).float()
 
-        annotations = targets[targets[:, 0] == sample_i][:, 1:]
-        target_labels = annotations[:, 0] if len(annotations) else []
-        if len(annotations):
-            detected_boxes = []
-            target_boxes = annotations[:, 1:]
 
-            for pred_i, (pred_box, pred_label) in enumerate(zip(pred_boxes, pred_labels)):
+def match_detections(iou, iou_threshold):
+    """
+    Greedy assignment of detections (rows, in order of confidence) to targets (columns).
+    Every detection is assigned to the target with the highest IoU above 'iou_threshold' and is
+    a true positive if no earlier detection was assigned to the same target.
+    iou_threshold: a single threshold or a sequence of thresholds, all matched on the same IoU matrix
+    Returns a bool tensor of true positives, (n_pred,) for a single threshold and
+    (n_pred, n_thresholds) for a sequence
+    """
+    n_pred, n_target = iou.shape
+    thresholds = torch.as_tensor(iou_threshold, dtype=iou.dtype, device=iou.device).reshape(-1, 1)
+    true_positives = torch.zeros((thresholds.size(0), n_pred), dtype=torch.bool, device=iou.device)
+    if iou.numel():
+        # Best target above the threshold for every threshold and detection
+        iou_matched = torch.where(iou.unsqueeze(0) >= thresholds.unsqueeze(2), iou.unsqueeze(0), torch.zeros_like(iou).unsqueeze(0))
+        iou_max, box_index = iou_matched.max(2)
+        matched = iou_max >= thresholds
+        thres_index, pred_index = matched.nonzero(as_tuple=True)
+        box_index = thres_index * n_target + box_index[matched]
+
+        # First detection per target and threshold: sort by (threshold, target, detection) and keep the head of every group
+        order = torch.argsort(box_index * n_pred + pred_index)
+        box_index, thres_index, pred_index = box_index[order], thres_index[order], pred_index[order]
+        first = torch.ones_like(box_index, dtype=torch.bool)
+        first[1:] = box_index[1:] != box_index[:-1]
+        true_positives[thres_index[first], pred_index[first]] = True
+
+    if torch.as_tensor(iou_threshold).dim() == 0:
+        return true_positives[0]
+    return true_positives.t()
 
-                # If targets are found break
-                if len(detected_boxes) == len(annotations):
-                    break
 
-                # Ignore if label is not one of the target labels
-                if pred_label not in target_labels:
-                    continue
+def get_batch_statistics(outputs, targets, iou_threshold, use_angle):
+    """ Compute true positives, predicted scores and predicted labels for all samples of a batch
+    outputs: packed detections of non_max_suppression, first column is the sample index
+    targets: (sample_index, label, x1, y1, x2, y2, angle)
+    iou_threshold: single threshold or sequence of thresholds (true positives get one column per threshold)
+    """
+    pred_scores = outputs[:, 6]
+    pred_labels = outputs[:, -1]
 
-                #iou, box_index = bbox_iou(pred_box.unsqueeze(0), target_boxes).max(0)     # Only checkes once, later if detection with better iou arrives will be ignored
-                if use_angle == 'True':
-                    iou = iou_rotated(pred_box.unsqueeze(0), target_boxes)
-                else:
-                    iou = bbox_iou(pred_box.unsqueeze(0), target_boxes)
-                mask_matched = (target_labels == pred_label) & (iou >= iou_threshold) 
+    iou = detection_target_iou(outputs, targets, use_angle)
+    true_positives = match_detections(iou, iou_threshold)
 
-                iou_matched = torch.where(mask_matched, iou, torch.zeros_like(iou))
-                iou_max, box_index = iou_matched.max(0)
+    return [[to_cpu(true_positives).float().numpy(), pred_scores, pred_labels]]
 
-                #if iou >= iou_threshold and box_index not in detected_boxes and pred_label == target_labels[box_index]:
-                if iou_max >= iou_threshold and box_index not in detected_boxes:
-                    true_positives[pred_i] = 1
-                    detected_boxes += [box_index]
-        batch_metrics.append([true_positives, pred_scores, pred_labels])
-    return batch_metrics
+def xywha2corners(boxes):
+    """
+    Corners of rotated bounding boxes, computed for all boxes at once on their device
+    boxes: (N, 5) tensor of (x, y, w, h, angle), angle in degree
+    Returns (N, 4, 2) tensor of the corners (-w/2, -h/2), (w/2, -h/2), (w/2, h/2), (-w/2, h/2)
+    rotated around the box center
+    """
+    x, y, w, h, angle = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3], boxes[:, 4]
+    c, s = torch.cos(angle / 180 * np.pi), torch.sin(angle / 180 * np.pi)
+    # Corner offsets from the center before rotation
+    dx = torch.stack((-w / 2, w / 2, w / 2, -w / 2), 1)
+    dy = torch.stack((-h / 2, -h / 2, h / 2, h / 2), 1)
+    # Rotate by [[c, s], [-s, c]]
+    corners_x = x.unsqueeze(1) + dx * c.unsqueeze(1) - dy * s.unsqueeze(1)
+    corners_y = y.unsqueeze(1) + dx * s.unsqueeze(1) + dy * c.unsqueeze(1)
+    return torch.stack((corners_x, corners_y), 2)
 
 def rotate_detections(x1, y1, x2, y2, angle, xyxy=True):
-
-    FloatTensor = torch.cuda.FloatTensor if x1.is_cuda else torch.FloatTensor
-
+    """
+    Corners of rotated detections, returns a (4, 2) tensor for single values and a (N, 4, 2) tensor otherwise
+    """
     if xyxy:
         w, h = x2 - x1, y2 - y1
         x, y = x1 + w/2, y1 + h/2   
@@ -247,29 +424,11 @@ def rotate_detections(x1, y1, x2, y2, angle, xyxy=True):
         x, y, w, h = x1, y1, x2, y2 
 
     # Get co-ordinates for rotated angle
-    if not x.size():
-
-        c, s = np.cos(angle/180*np.pi), np.sin(angle/180*np.pi)
-        R = np.asarray([[c, s], [-s, c]])
-        pts = np.asarray([[-w/2, -h/2], [w/2, -h/2], [w/2, h/2], [-w/2, h/2]])
-        rot_pts = []
-        for pt in pts:
-            rot_pts.append(([x, y] + pt @ R).astype(float))
-        contours = FloatTensor([rot_pts[0], rot_pts[1], rot_pts[2], rot_pts[3]])
-        
-    else:
-        contours = []
+    boxes = torch.stack([torch.as_tensor(v, dtype=torch.float) for v in (x, y, w, h, angle)], -1)
+    if boxes.dim() == 1:
+        return xywha2corners(boxes.unsqueeze(0))[0]
 
-        for i in range(x.size(0)):
-            c, s = np.cos(angle[i]/180*np.pi), np.sin(angle[i]/180*np.pi)
-            R = np.asarray([[c, s], [-s, c]])
-            pts = np.asarray([[-w[i]/2, -h[i]/2], [w[i]/2, -h[i]/2], [w[i]/2, h[i]/2], [-w[i]/2, h[i]/2]])
-            rot_pts = []
-            for pt in pts:
-                rot_pts.append(([x[i], y[i]] + pt @ R).astype(float))
-            contours += [FloatTensor([rot_pts[0], rot_pts[1], rot_pts[2], rot_pts[3]])]
-
-    return contours
+    return xywha2corners(boxes)
 
 
 def bbox_wh_iou(wh1, wh2):
@@ -313,231 +472,359 @@ def bbox_iou(box1, box2, x1y1x2y2=True):
 
     return iou
 
+def bbox_iou_matrix(box1, box2):
+    """
+    Returns the pairwise IoU matrix of two sets of (x1, y1, x2, y2) bounding boxes
+    """
+    # get the corrdinates of the intersection rectangles
+    inter_rect_x1 = torch.max(box1[:, None, 0], box2[None, :, 0])
+    inter_rect_y1 = torch.max(box1[:, None, 1], box2[None, :, 1])
+    inter_rect_x2 = torch.min(box1[:, None, 2], box2[None, :, 2])
+    inter_rect_y2 = torch.min(box1[:, None, 3], box2[None, :, 3])
+    # Intersection area
+    inter_area = torch.clamp(inter_rect_x2 - inter_rect_x1, min=0) * torch.clamp(
+        inter_rect_y2 - inter_rect_y1, min=0
+    )
+    # Union Area
+    b1_area = (box1[:, 2] - box1[:, 0]) * (box1[:, 3] - box1[:, 1])
+    b2_area = (box2[:, 2] - box2[:, 0]) * (box2[:, 3] - box2[:, 1])
+
+    iou = inter_area / (b1_area[:, None] + b2_area[None, :] - inter_area + 1e-16)
+
+    return iou
+
 def calculate_rotated(x, y, w, h, angle):
     '''
     angle: degree
     '''
-    FloatTensor = torch.cuda.FloatTensor if x.is_cuda else torch.FloatTensor
-
-    w = w.item()
-    h = h.item()
-    #w, h = w.numpy(), h.numpy()
-    c, s = np.cos(angle.item()/180*np.pi), np.sin(angle.item()/180*np.pi)
-    R = np.asarray([[c, s], [-s, c]])
-    pts = np.asarray([[-w/2, -h/2], [w/2, -h/2], [w/2, h/2], [-w/2, h/2]])
-    rot_pts = []
-    for pt in pts:
-        rot_pts.append(([x, y] + pt @ R).astype(float))
-    contours = FloatTensor([rot_pts[0], rot_pts[1], rot_pts[2], rot_pts[3]])
-    
-    return contours
+    return xywha2corners(torch.stack((x, y, w, h, angle)).float().unsqueeze(0))[0]
 
 def iou_rotated(box1, box2, x1y1x2y2=True):
-
+    """
+    Returns the IoU of rotated bounding boxes (x1, y1, x2, y2, angle), either of one box in box1
+    against every box in box2 or of box1[i] against box2[i]
+    """
     FloatTensor = torch.cuda.FloatTensor if box1.is_cuda else torch.FloatTensor
 
-    if not x1y1x2y2:
-        #Get center co-ordinates and w & h
-        b1_cx, b1_cy, b1_w, b1_h = box1[:,0], box1[:,1], box1[:,2], box1[:,3]
-        b2_cx, b2_cy, b2_w, b2_h = box2[:,0], box2[:,1], box2[:,2], box2[:,3]
-       
-    else:
+    box1 = box1[:, :5].clone()
+    box2 = box2[:, :5].clone()
+    if x1y1x2y2:
         # Transform co-ordinates to x,y,w,h
-        b1_w, b1_h = box1[:,2] - box1[:,0], box1[:,3] - box1[:,1]
-        b1_cx, b1_cy = box1[:,0] + b1_w / 2, box1[:,1] + b1_h / 2
-        
-        b2_w, b2_h = box2[:,2] - box2[:,0], box2[:,3] - box2[:,1]
-        b2_cx, b2_cy = box2[:,0] + b2_w / 2, box2[:,1] + b2_h / 2
-        
-    
-    #get angle for rotation for all bounding boxes
-    angle_1 = box1[:,-1]
-    angle_2 = box2[:,-1]
-
-    if len(box1) == 1:
-        iou_all = FloatTensor(box2.size(0)).fill_(0)
-        for i in range(len(box2)):
-            #Check if any element equals to infinity
-            if box1[0,0]==np.inf  or box1[0,1]==np.inf or box1[0,2]==np.inf or box1[0,3]==np.inf \
-            or box1[0,0]==np.nan  or box1[0,1]==np.nan or box1[0,2]==np.nan or box1[0,3]==np.nan:
-                iou = 1e-12
-            else:
-                rot_box1 = calculate_rotated(b1_cx[0], b1_cy[0], b1_w[0], b1_h[0], angle_1[0])
-                rot_box2 = calculate_rotated(b2_cx[i], b2_cy[i], b2_w[i], b2_h[i], angle_2[i])
-
-                # b1_x1, b1_y1 = rot_box1.min(0)[0]
-                # b1_x2, b1_y2 = rot_box1.max(0)[0]
-                # b2_x1, b2_y1 = rot_box2.min(0)[0]
-                # b2_x2, b2_y2 = rot_box2.max(0)[0]
-
-                # # get the co-ordinates of the intersection rectangle
-                # inter_rect_x1 = torch.max(b1_x1, b2_x1)
-                # inter_rect_y1 = torch.max(b1_y1, b2_y1)
-                # inter_rect_x2 = torch.min(b1_x2, b2_x2)
-                # inter_rect_y2 = torch.min(b1_y2, b2_y2)
-                # # Intersection area
-                # inter_area = torch.clamp(inter_rect_x2 - inter_rect_x1 + 1, min=0) * torch.clamp(
-                #     inter_rect_y2 - inter_rect_y1 + 1, min=0
-                # )
-                # # Union Area
-                # b1_area = (b1_x2 - b1_x1 + 1) * (b1_y2 - b1_y1 + 1)
-                # b2_area = (b2_x2 - b2_x1 + 1) * (b2_y2 - b2_y1 + 1)
-
-                # iou = inter_area / (b1_area + b2_area - inter_area + 1e-16)
-
-                try:
-                    rot_box1 = Polygon( [ rot_box1[0], rot_box1[1], rot_box1[2], rot_box1[3] ] )
-                    rot_box2 = Polygon( [ rot_box2[0], rot_box2[1], rot_box2[2], rot_box2[3] ] )
-
-                    if rot_box1.is_valid == False or rot_box2.is_valid == False:
-                        rot_box1 = rot_box1.buffer(0)
-                        rot_box2 = rot_box2.buffer(0)
-
-                    # Intersection area
-                    inter_area = rot_box1.intersection(rot_box2).area
-                    # Union Area
-                    union_area = rot_box1.union(rot_box2).area
-
-                    iou = inter_area / (union_area + 1e-9)
-                except Exception as inst:
-                    #print(inst)
-                    iou = 1e-9
-                    pass
-
-            iou_all[i] = iou
+        box1[:, :4] = xyxy2xywh(box1[:, :4])
+        box2[:, :4] = xyxy2xywh(box2[:, :4])
 
-        return iou_all
-
-    else:
+    if len(box1) != 1:
         assert(len(box1) == len(box2))
-        #rotate every bbox
-        iou_all = FloatTensor(box1.size(0)).fill_(0)
-        for i in range(len(box1)):
-            #Check if any element equals to infinity
-            if box1[i,0]==np.inf or box1[i,1]==np.inf or box1[i,2]==np.inf or box1[i,3]==np.inf \
-            or box1[i,0]==np.nan or box1[i,1]==np.nan or box1[i,2]==np.nan or box1[i,3]==np.nan:
-                iou = 1e-12
-            else:
-                rot_box1 = calculate_rotated(b1_cx[i], b1_cy[i], b1_w[i], b1_h[i], angle_1[i])
-                rot_box2 = calculate_rotated(b2_cx[i], b2_cy[i], b2_w[i], b2_h[i], angle_2[i])
-
-                # b1_x1, b1_y1 = rot_box1.min(0)[0]
-                # b1_x2, b1_y2 = rot_box1.max(0)[0]
-                # b2_x1, b2_y1 = rot_box2.min(0)[0]
-                # b2_x2, b2_y2 = rot_box2.max(0)[0]
-
-                # # get the co-ordinates of the intersection rectangle
-                # inter_rect_x1 = torch.max(b1_x1, b2_x1)
-                # inter_rect_y1 = torch.max(b1_y1, b2_y1)
-                # inter_rect_x2 = torch.min(b1_x2, b2_x2)
-                # inter_rect_y2 = torch.min(b1_y2, b2_y2)
-                # # Intersection area
-                # inter_area = torch.clamp(inter_rect_x2 - inter_rect_x1 + 1, min=0) * torch.clamp(
-                #     inter_rect_y2 - inter_rect_y1 + 1, min=0
-                # )
-                # # Union Area
-                # b1_area = (b1_x2 - b1_x1 + 1) * (b1_y2 - b1_y1 + 1)
-                # b2_area = (b2_x2 - b2_x1 + 1) * (b2_y2 - b2_y1 + 1)
-
-                # iou = inter_area / (b1_area + b2_area - inter_area + 1e-16)
-
-                try:
-                    rot_box1 = Polygon( [ rot_box1[0], rot_box1[1], rot_box1[2], rot_box1[3] ] )
-                    rot_box2 = Polygon( [ rot_box2[0], rot_box2[1], rot_box2[2], rot_box2[3] ] )
-
-                    if rot_box1.is_valid == False or rot_box2.is_valid == False:
-                        rot_box1 = rot_box1.buffer(0)
-                        rot_box2 = rot_box2.buffer(0)
-                    # Intersection area
-                    inter_area = rot_box1.intersection(rot_box2).area
-                    # Union Area
-                    union_area = rot_box1.union(rot_box2).area
-
-                    iou = inter_area / union_area
-                except Exception as inst:
-                    #print(inst)
-                    iou = 1e-9
-                    pass
-
-
-            iou_all[i] = iou
 
+    # Rotate every bbox at once
+    corners1 = to_cpu(xywha2corners(box1)).numpy()
+    corners2 = to_cpu(xywha2corners(box2)).numpy()
+    #Check if any element equals to infinity
+    invalid = to_cpu(~torch.isfinite(box1[:, :4]).all(1)).tolist()
+
+    iou_all = [0] * len(box2)
+    for i in range(len(box2)):
+        i1 = 0 if len(box1) == 1 else i
+        if invalid[i1]:
+            iou = 1e-12
+        else:
+            try:
+                rot_box1 = Polygon( corners1[i1] )
+                rot_box2 = Polygon( corners2[i] )
+
+                if rot_box1.is_valid == False or rot_box2.is_valid == False:
+                    rot_box1 = rot_box1.buffer(0)
+                    rot_box2 = rot_box2.buffer(0)
+
+                # Intersection area
+                inter_area = rot_box1.intersection(rot_box2).area
+                # Union Area
+                union_area = rot_box1.union(rot_box2).area
+
+                iou = inter_area / (union_area + 1e-9)
+            except Exception as inst:
+                iou = 1e-9
+
+        iou_all[i] = iou
+
+    return FloatTensor(iou_all)
+
+def rotated_candidate_pairs(box1, box2=None, group1=None, group2=None):
+    """
+    Finds the pairs of (x, y, w, h, angle) boxes whose circumscribed circles overlap.
+    Boxes of box2 are sorted by the left edge of their circle, so every box of box1 only
+    looks at the sorted window that can reach it (sweep and prune).
+    box2=None: pairs (i, j) with i < j of box1 against itself
+    group1, group2: optional ids (e.g. class or image index), only pairs of the same group are returned
+    """
+    self_pairs = box2 is None
+    if self_pairs:
+        box2, group2 = box1, group1
+
+    device = box1.device
+    if not len(box1) or not len(box2):
+        empty = torch.zeros(0, dtype=torch.long, device=device)
+        return empty, empty
+
+    # Radius of the circle around each rotated box
+    r1 = 0.5 * torch.sqrt(box1[:, 2] ** 2 + box1[:, 3] ** 2)
+    r2 = 0.5 * torch.sqrt(box2[:, 2] ** 2 + box2[:, 3] ** 2)
+
+    # Circles can only overlap if the left edge of circle j lies in [x_i - r_i - 2 * max(r), x_i + r_i]
+    lo2, order = torch.sort(box2[:, 0] - r2)
+    start = torch.searchsorted(lo2, (box1[:, 0] - r1 - 2 * r2.max()).contiguous())
+    end = torch.searchsorted(lo2, (box1[:, 0] + r1).contiguous(), right=True)
+    counts = (end - start).clamp(min=0)
+
+    # Expand the windows to explicit index pairs
+    idx1 = torch.repeat_interleave(torch.arange(len(box1), device=device), counts)
+    first = torch.repeat_interleave(start - (torch.cumsum(counts, 0) - counts), counts)
+    idx2 = order[first + torch.arange(idx1.size(0), device=device)]
+
+    # Exact circle overlap test
+    dist = (box1[idx1, 0] - box2[idx2, 0]) ** 2 + (box1[idx1, 1] - box2[idx2, 1]) ** 2
+    valid = dist <= (r1[idx1] + r2[idx2]) ** 2
+    if self_pairs:
+        valid &= idx1 < idx2
+    if group1 is not None:
+        valid &= group1[idx1] == group2[idx2]
+
+    return idx1[valid], idx2[valid]
+
+def rotated_polygons(boxes):
+    """
+    Builds one shapely polygon per (x, y, w, h, angle) box
+    """
+    polygons = []
+    for rot_box in to_cpu(xywha2corners(boxes)).numpy():
+        polygon = Polygon( rot_box )
+        if polygon.is_valid == False:
+            polygon = polygon.buffer(0)
+        polygons.append(polygon)
+
+    return polygons
+
+def rotated_iou_matrix(box1, box2=None, x1y1x2y2=True, group1=None, group2=None):
+    """
+    Returns the pairwise IoU matrix of rotated bounding boxes (x1, y1, x2, y2, angle).
+    Pairs are pruned with circumscribed-circle tests first, exact polygon IoU is only
+    computed for the remaining candidates. Pruned pairs have an IoU of 0.
+    box2=None: symmetric IoU matrix of box1 with itself (diagonal set to 1)
+    """
+    FloatTensor = torch.cuda.FloatTensor if box1.is_cuda else torch.FloatTensor
+
+    self_pairs = box2 is None
+    if self_pairs:
+        box2, group2 = box1, group1
+
+    # Transform co-ordinates to x,y,w,h
+    box1 = box1[:, :5].clone()
+    box2 = box2[:, :5].clone()
+    if x1y1x2y2:
+        box1[:, :4] = xyxy2xywh(box1[:, :4])
+        box2[:, :4] = xyxy2xywh(box2[:, :4])
+
+    iou_all = FloatTensor(box1.size(0), box2.size(0)).fill_(0)
+    if self_pairs:
+        iou_all.fill_diagonal_(1)
+        idx1, idx2 = rotated_candidate_pairs(box1, group1=group1)
+    else:
+        idx1, idx2 = rotated_candidate_pairs(box1, box2, group1=group1, group2=group2)
+    if not idx1.size(0):
         return iou_all
 
+    # Build polygons once per box that takes part in a candidate pair
+    if self_pairs:
+        used1 = torch.unique(torch.cat((idx1, idx2))).tolist()
+        polys1 = polys2 = dict(zip(used1, rotated_polygons(box1[used1])))
+    else:
+        used1, used2 = torch.unique(idx1).tolist(), torch.unique(idx2).tolist()
+        polys1 = dict(zip(used1, rotated_polygons(box1[used1])))
+        polys2 = dict(zip(used2, rotated_polygons(box2[used2])))
+
+    ious = []
+    for p1, p2 in zip(idx1.tolist(), idx2.tolist()):
+        try:
+            # Intersection area
+            inter_area = polys1[p1].intersection(polys2[p2]).area
+            # Union Area
+            union_area = polys1[p1].area + polys2[p2].area - inter_area
+            iou = inter_area / (union_area + 1e-9)
+        except Exception as inst:
+            iou = 1e-9
+        ious.append(iou)
+
+    iou_all[idx1, idx2] = FloatTensor(ious)
+    if self_pairs:
+        iou_all[idx2, idx1] = FloatTensor(ious)
+
+    return iou_all
+
+
+def _sync_time(tensor):
+    """ perf_counter after waiting for pending CUDA work of 'tensor' """
+    if tensor.is_cuda:
+        torch.cuda.synchronize(tensor.device)
+    return time.perf_counter()
+
+def _record_nms_timings(timings, tensor, start_time, select_time=None):
+    """ Appends the stage times of one image, without select_time no candidate was left for NMS """
+    if timings is None:
+        return
+    end_time = _sync_time(tensor)
+    if select_time is None:
+        select_time = end_time
+    timings.setdefault("select", []).append(select_time - start_time)
+    timings.setdefault("nms", []).append(end_time - select_time)
+    timings.setdefault("total", []).append(end_time - start_time)
+
+def latency_summary(timings, percentiles=(50, 99)):
+    """
+    Summarises the per image stage timings collected by non_max_suppression
+    Returns rows of [stage, mean, *percentiles, max] in milliseconds
+    """
+    rows = []
+    for stage, values in timings.items():
+        values = np.array(values) * 1000
+        rows += [[stage, values.mean(), *np.percentile(values, percentiles), values.max()]]
+    return rows
 
-def non_max_suppression(prediction, use_angle, conf_thres=0.5, nms_thres=0.4):
+def matrix_nms(detections, iou, nms_thres, nms_mode="cluster"):
+    """
+    Performs Non-Maximum Suppression on the pairwise IoU matrix of detections sorted by score,
+    without a Python loop over the kept boxes.
+    nms_mode 'fast': drops every box overlapped by any higher scoring box of the same class (Fast NMS)
+    nms_mode 'cluster': repeats Fast NMS with only the kept boxes suppressing until the keep set
+                        is stable, which keeps the same boxes as greedy NMS (Cluster-NMS)
+    Each kept box is merged with the boxes it suppresses, weighted by object confidence as in
+    the greedy NMS.
+    """
+    n = detections.size(0)
+    label_match = detections[:, -1].unsqueeze(0) == detections[:, -1].unsqueeze(1)
+    # overlap[i, j]: higher scoring box i would suppress box j
+    overlap = ((iou > nms_thres) & label_match).triu(diagonal=1)
+
+    keep = ~overlap.any(0)
+    if nms_mode == "cluster":
+        for _ in range(n):
+            keep_next = ~(overlap & keep.unsqueeze(1)).any(0)
+            if torch.equal(keep_next, keep):
+                break
+            keep = keep_next
+
+    # Every box is merged into the first kept box that suppresses it (kept boxes into themselves)
+    eye = torch.eye(n, dtype=torch.bool, device=detections.device)
+    owner_mask = (overlap | eye) & keep.unsqueeze(1)
+    owned = owner_mask.any(0)
+    owner = owner_mask.float().argmax(0)[owned]
+    weights = detections[owned, 5:6]
+    merged = torch.zeros_like(detections[:, :4]).index_add_(0, owner, weights * detections[owned, :4])
+    weights_sum = torch.zeros_like(detections[:, 5:6]).index_add_(0, owner, weights)
+
+    detections = detections[keep]
+    detections[:, :4] = merged[keep] / weights_sum[keep]
+    return detections
+
+def non_max_suppression(prediction, use_angle, conf_thres=0.5, nms_thres=0.4, nms_mode="greedy", pre_nms_topk=None,
+                        pre_nms_topk_per_class=None, max_det=None, timings=None):
     """
     Removes detections with lower object confidence score than 'conf_thres' and performs
     Non-Maximum Suppression to further filter detections.
-    Returns detections with shape:
-        (x1, y1, x2, y2, object_conf, class_score, class_pred)
+    nms_mode: 'greedy' removes overlapping boxes one kept box at a time, 'fast' and 'cluster'
+              derive the kept boxes from the IoU matrix in one go (see matrix_nms)
+    pre_nms_topk: keep at most this many highest scoring candidates per image before suppression
+    pre_nms_topk_per_class: keep at most this many highest scoring candidates per class before suppression
+    max_det: keep at most this many detections per image after suppression
+    timings: optional dict, the seconds spent per image in each stage ("select", "nms", "total")
+             are appended to timings[stage]
+    Returns the detections of the whole batch packed in one tensor with shape (K, 9):
+        (sample_index, x1, y1, x2, y2, angle, object_conf, class_score, class_pred)
+    grouped by sample, and offsets (batch_size + 1,) so that the detections of sample i
+    are detections[offsets[i]:offsets[i + 1]]
     """
 
     # From (center x, center y, width, height) to (x1, y1, x2, y2)
     prediction[..., :4] = xywh2xyxy(prediction[..., :4])
     output = [None for _ in range(len(prediction))]
     for image_i, image_pred in enumerate(prediction):
+        start_time = _sync_time(image_pred) if timings is not None else None
         # Filter out confidence scores below threshold
         image_pred = image_pred[image_pred[:, 5] >= conf_thres]
         # If none are remaining => process next image
         if not image_pred.size(0):
+            _record_nms_timings(timings, image_pred, start_time)
             continue
         # Object confidence times class confidence
-        score = image_pred[:, 5] * image_pred[:, 6:].max(1)[0]
+        class_confs, class_preds = image_pred[:, 6:].max(1)
+        score = image_pred[:, 5] * class_confs
+        # Partial sort: keep only the highest scoring candidates per class and per image
+        candidates = torch.arange(score.size(0), device=score.device)
+        if pre_nms_topk_per_class is not None:
+            per_class = []
+            for c in class_preds.unique():
+                in_class = candidates[class_preds == c]
+                per_class += [in_class[score[in_class].topk(min(pre_nms_topk_per_class, in_class.size(0)))[1]]]
+            candidates = torch.cat(per_class)
+        if pre_nms_topk is not None and candidates.size(0) > pre_nms_topk:
+            candidates = candidates[score[candidates].topk(pre_nms_topk)[1]]
         # Sort by it
-        image_pred = image_pred[(-score).argsort()]
+        image_pred = image_pred[candidates[(-score[candidates]).argsort()]]
         class_confs, class_preds = image_pred[:, 6:].max(1, keepdim=True)
         detections = torch.cat((image_pred[:, :6], class_confs.float(), class_preds.float()), 1)
 
-    #     ##### takes boxes for filtering
-    #     boxes = detections[:,0:5] # only [x,y,w,h,a]
-    #     valid = torch.zeros(boxes.shape[0], dtype=torch.bool)
-    #     # the first one is always valid
-    #     valid[0] = True
-    #     # only one candidate at the beginning. Its votes number is 1 (it self)
-    #     votes = [1]
-    #     for i in range(1, boxes.shape[0]):
-    #     # compute IoU with valid boxes
-
-    #         ious = iou_rotated(boxes[i].unsqueeze(0), boxes[valid,:])
-    #         if (ious >= nms_thres).any():
-    #             continue
-    #         # else, this box is valid
-    #         valid[i] = True
-    #         # the votes number of the new candidate BB is 1 (it self)
-    #         votes.append(1)
-    #     selected = detections[valid,:]
-
-    #     if selected:
-    #         output[image_i] = torch.stack(selected)
-
-    # return selected
-
-        
-        # Perform non-maximum suppression
-        keep_boxes = []
-        while detections.size(0):
+        select_time = _sync_time(image_pred) if timings is not None else None
+
+        # Perform non-maximum suppression on the IoU matrix
+        if nms_mode != "greedy":
             if use_angle == 'True':
-                large_overlap = iou_rotated(detections[0, :5].unsqueeze(0), detections[:, :5]) > nms_thres
+                iou = rotated_iou_matrix(detections[:, :5], group1=detections[:, -1])
             else:
+                iou = bbox_iou_matrix(detections[:, :4], detections[:, :4])
+            output[image_i] = matrix_nms(detections, iou, nms_thres, nms_mode=nms_mode)[:max_det]
+            _record_nms_timings(timings, image_pred, start_time, select_time)
+            continue
+
+        # Perform non-maximum suppression
+        keep_boxes = []
+        if use_angle == 'True':
+            # Polygon IoU is only computed once for same-class pairs whose circumscribed circles overlap
+            large_overlap = rotated_iou_matrix(detections[:, :5], group1=detections[:, -1]) > nms_thres
+            large_overlap.fill_diagonal_(True)
+            remaining = torch.ones(detections.size(0), dtype=torch.bool, device=detections.device)
+            for i in range(detections.size(0)):
+                if not remaining[i]:
+                    continue
+                # Indices of remaining boxes with lower confidence scores, large IOUs and matching labels
+                invalid = large_overlap[i] & remaining
+                weights = detections[invalid, 5:6]
+                # Merge overlapping bboxes by order of confidence
+                detections[i, :4] = (weights * detections[invalid, :4]).sum(0) / weights.sum()
+                keep_boxes += [detections[i]]
+                remaining &= ~invalid
+        else:
+            while detections.size(0):
                 large_overlap = bbox_iou(detections[0, :4].unsqueeze(0), detections[:, :4]) > nms_thres
-            label_match = detections[0, -1] == detections[:, -1]
-            # Indices of boxes with lower confidence scores, large IOUs and matching labels
-            invalid = large_overlap & label_match
-            weights = detections[invalid, 5:6]
-            # Merge overlapping bboxes by order of confidence
-            detections[0, :4] = (weights * detections[invalid, :4]).sum(0) / weights.sum()
-            keep_boxes += [detections[0]]
-            detections = detections[~invalid]
+                label_match = detections[0, -1] == detections[:, -1]
+                # Indices of boxes with lower confidence scores, large IOUs and matching labels
+                invalid = large_overlap & label_match
+                weights = detections[invalid, 5:6]
+                # Merge overlapping bboxes by order of confidence
+                detections[0, :4] = (weights * detections[invalid, :4]).sum(0) / weights.sum()
+                keep_boxes += [detections[0]]
+                detections = detections[~invalid]
         if keep_boxes:
-            output[image_i] = torch.stack(keep_boxes)
+            output[image_i] = torch.stack(keep_boxes)[:max_det]
+        _record_nms_timings(timings, image_pred, start_time, select_time)
     
-    for o_i, out in enumerate(output):
-        if out == None:
-            output[o_i] = torch.zeros(1,8)
-            
+    # Pack detections of all samples with their sample index
+    counts = torch.LongTensor([0 if out is None else out.size(0) for out in output])
+    offsets = torch.zeros(len(output) + 1, dtype=torch.long)
+    offsets[1:] = torch.cumsum(counts, 0)
+    sample_index = torch.repeat_interleave(torch.arange(len(output)), counts).to(prediction)
+    detections = torch.cat([out for out in output if out is not None] or [prediction.new_zeros((0, 8))])
+    detections = torch.cat((sample_index.unsqueeze(1), detections), 1)
 
-    return output
+    return detections, offsets
 
 
 def build_targets(pred_boxes, pred_cls, target, anchors, ignore_thres, use_angle):
@@ -549,23 +836,25 @@ def build_targets(pred_boxes, pred_cls, target, anchors, ignore_thres, use_angle
     nA = pred_boxes.size(1)
     nC = pred_cls.size(-1)
     nG = pred_boxes.size(2)
+    nGw = pred_boxes.size(3)  # Columns, differ from the rows for rectangular inputs
     nt = target.size(0)
 
     # Output tensors
-    obj_mask = ByteTensor(nB, nA, nG, nG).fill_(0)
-    noobj_mask = ByteTensor(nB, nA, nG, nG).fill_(1)
-    class_mask = FloatTensor(nB, nA, nG, nG).fill_(0)
-    iou_scores = FloatTensor(nB, nA, nG, nG).fill_(0)
-    tx = FloatTensor(nB, nA, nG, nG).fill_(0)
-    ty = FloatTensor(nB, nA, nG, nG).fill_(0)
-    tw = FloatTensor(nB, nA, nG, nG).fill_(0)
-    th = FloatTensor(nB, nA, nG, nG).fill_(0)
-    tangle = FloatTensor(nB, nA, nG, nG).fill_(0)
-    tcls = FloatTensor(nB, nA, nG, nG, nC).fill_(0)
+    obj_mask = ByteTensor(nB, nA, nG, nGw).fill_(0)
+    noobj_mask = ByteTensor(nB, nA, nG, nGw).fill_(1)
+    class_mask = FloatTensor(nB, nA, nG, nGw).fill_(0)
+    iou_scores = FloatTensor(nB, nA, nG, nGw).fill_(0)
+    tx = FloatTensor(nB, nA, nG, nGw).fill_(0)
+    ty = FloatTensor(nB, nA, nG, nGw).fill_(0)
+    tw = FloatTensor(nB, nA, nG, nGw).fill_(0)
+    th = FloatTensor(nB, nA, nG, nGw).fill_(0)
+    tangle = FloatTensor(nB, nA, nG, nGw).fill_(0)
+    tcls = FloatTensor(nB, nA, nG, nGw, nC).fill_(0)
     target_boxes = FloatTensor(nt,5).fill_(0)
 
     # Convert to position relative to box
-    target_boxes[:,:4] = target[:, 2:6] * nG
+    target_boxes[:, [0, 2]] = target[:, [2, 4]] * nGw
+    target_boxes[:, [1, 3]] = target[:, [3, 5]] * nG
     target_boxes[:,4] = target[:, 6]
     gxy = target_boxes[:, :2]
     gwh = target_boxes[:, 2:4]